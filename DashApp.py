@@ -14,6 +14,8 @@ class TreeStatsApp(GenericApp):
 		#self.AddSimulation(TreeLoaderSim())
 		self.AddAnalyzer(TreeVisualizer())
 		self.AddAnalyzer(TreeStatAnalyzer())
+		self.AddAnalyzer(RateThroughTimeAnalyzer())
+		self.AddAnalyzer(W2SurrogateAnalyzer())
 
 app = dash.Dash(__name__)
 
@@ -31,4 +33,6 @@ app.layout = html.Div(children = [
 
 tsa.BuildAllSignals(app)
 
-app.run_server(debug=True)
+# Process pool workers import this module without running the server
+if __name__ == '__main__':
+	app.run_server(debug=True)
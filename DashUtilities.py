@@ -162,6 +162,8 @@ class DashInterfacable(Interfacable):
 						oneUpdt = True
 			if not oneUpdt:
 				raise dash.exceptions.PreventUpdate
+			# Let the app know which objects need to be recomputed on next analysis
+			self.SetModified()
 			return random.random()
 		return UpdateValues
 
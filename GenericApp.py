@@ -1,6 +1,7 @@
 from ResultAnalyzers import *
 from DashUtilities import *
 from GenericAppState import *
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 class GenericApp(Parameterizable, Usable, DashInterfacable):
 	def __init__(self):
@@ -12,13 +13,16 @@ class GenericApp(Parameterizable, Usable, DashInterfacable):
 		self.analyzers = []
 		self.simManager = SimulationManager('{}_sims.pkl'.format(self.__class__.__name__))
 		self.results = None
+		# Results of the last analysis for each (element, source) node, see Analyze
+		self._nodeResults = {}
 
 		self.stateSaver = GenericAppStateSaver(self)
 		self.stateLoader = GenericAppStateLoader(self)
 
 	def GetDefaultParams(self):
 		return ParametersDescr({
-			'memoize': (False, bool,)
+			'memoize': (False, bool,),
+			'nbWorkers': (4, int)
 		})
 
 	def GetElemFromName(self, name):
@@ -27,17 +31,107 @@ class GenericApp(Parameterizable, Usable, DashInterfacable):
 				return elem
 		return None
 
+	# Only recomputes the elements that were modified since the last analysis, and the ones downstream of them.
+	# Elements (and per source analyses) are run concurrently as soon as the elements they depend on are done.
 	@Usable.Clickable('special', 'innerLayout', 'children')
 	def Analyze(self):
+		sortedElems = self._getSortedElems()
+		# Results of the finished elements, only modified from this thread
+		available = Results(self)
+		elemNodes = {}
+		elemResults = {}
+		nodeResults = {}
+		recomputed = set()
+		futures = {}
+		with ThreadPoolExecutor(max_workers = max(1, self.nbWorkers)) as pool:
+			while len(elemResults) < len(sortedElems):
+				# Start the elements whose upstream elements are all finished
+				for elem in sortedElems:
+					ups = self.GetUpstreamElems(elem)
+					if elem not in elemNodes and all(up in elemResults for up in ups):
+						modified = elem.IsModified()
+						upstreamRecomputed = any(up in recomputed for up in ups)
+						elemNodes[elem] = []
+						for src in self._getElemSources(elem, available):
+							node = (elem, src)
+							elemNodes[elem].append(node)
+							if node not in self._nodeResults or modified or (upstreamRecomputed if src is None else src in recomputed):
+								futures[pool.submit(self._computeNode, elem, self._getNodeInputs(elem, src, available))] = node
+								recomputed.add(elem)
+							else:
+								nodeResults[node] = self._nodeResults[node]
+
+				# Make the results of finished elements available to the next ones
+				finished = [elem for elem, nodes in elemNodes.items() if elem not in elemResults and all(node in nodeResults for node in nodes)]
+				for elem in finished:
+					elemResults[elem] = Results(elem)
+					for node in elemNodes[elem]:
+						elemResults[elem].addResults(nodeResults[node])
+					available.addResults(elemResults[elem])
+
+				if len(finished) == 0:
+					done, notDone = wait(futures, return_when = FIRST_COMPLETED)
+					for future in done:
+						nodeResults[futures.pop(future)] = future.result()
+
+		# Gather results in a deterministic order
 		self.results = Results(self)
-		for sim in self.simulations:
-			self.results.addResults(self.simManager.GetSimulationResult(sim, self.memoize))
-
-		for analyzer in self.analyzers:
-			self.results.addResults(analyzer.Analyze(self.results))
+		for elem in sortedElems:
+			self.results.addResults(elemResults[elem])
+		for elem in sortedElems:
+			if isinstance(elem, ResultAnalyzer):
+				elem.ReuseResults(self.results, elemResults[elem])
+			elem.ClearModified()
+		self._nodeResults = nodeResults
 
 		return self._getInnerLayout()
 
+	# Runs a simulation or an analysis on its own inputs, called from the worker threads
+	def _computeNode(self, elem, inputs):
+		if isinstance(elem, SimulationRunner):
+			return self.simManager.GetSimulationResult(elem, self.memoize)
+		else:
+			return self.simManager.GetAnalysisResult(elem, inputs, self.memoize)
+
+	# Returns a new Results object holding what the node can use, restricted to the given source for its inputs
+	def _getNodeInputs(self, elem, src, available):
+		inputs = elem.GetInputs()
+		return available.Filter(lambda oah: src is None or oah.name not in inputs or oah.owner == src)
+
+	# Forgets the results of the last analysis, the next one will recompute everything
+	def ClearNodeResults(self):
+		self._nodeResults = {}
+
+	# Returns the producers of the inputs of elem that are analyzed separately, or [None] if elem is computed at once
+	def _getElemSources(self, elem, results):
+		if isinstance(elem, ResultAnalyzer) and elem.IsAnalyzedPerSource():
+			srcs = []
+			for name in elem.GetInputs():
+				for oah in results.GetOwnedAttr(name):
+					if oah.owner not in srcs:
+						srcs.append(oah.owner)
+			if len(srcs) > 0:
+				return srcs
+		return [None]
+
+	# Returns the elements whose outputs are used by elem, from its inputs and its class dependencies
+	def GetUpstreamElems(self, elem):
+		ups = [p for name in elem.GetInputs() for p in self.GetProducers(name)]
+		if isinstance(elem, ResultAnalyzer):
+			ups += [e for dep in elem.DependsOn() for e in self.simulations + self.analyzers if isinstance(e, dep)]
+		return [e for i, e in enumerate(ups) if e is not elem and e not in ups[:i]]
+
+	# Returns all elements sorted so that each element comes after the ones it depends on, keeping the insertion order otherwise
+	def _getSortedElems(self):
+		allElems = self.simulations + self.analyzers
+		sortedElems = []
+		while len(sortedElems) < len(allElems):
+			ready = [e for e in allElems if e not in sortedElems and all(up in sortedElems for up in self.GetUpstreamElems(e))]
+			if len(ready) == 0:
+				raise ValueError('Cyclic dependency between {}.'.format(', '.join(e.GetUniqueName() for e in allElems if e not in sortedElems)))
+			sortedElems.append(ready[0])
+		return sortedElems
+
 	def _getStateLayout(self):
 		# State Layout
 		simElems = [sim.GetLayout() for sim in self.simulations if isinstance(sim, DashInterfacable)]
@@ -106,9 +106,11 @@ class GenericAppStateLoader(Parameterizable, Usable, DashInterfacable):
 					oah.owner = elemNames[name]
 				else:
 					raise Exception('{} could not be found in the current application. Results element could not be re-owned.'.format(name))
+		results.RebuildIndex()
 
 		# Set all results
 		self.app.results = results
+		self.app.ClearNodeResults()
 		for elem in self.app.simulations + self.app.analyzers:
 			elem.SetResults(self.app.results)
 
@@ -0,0 +1,86 @@
+import numpy as np
+from Utilities import *
+
+#################
+# ROC computing #
+#################
+
+# Maximum number of resampled values held at once by bootstrapROC
+maxBootstrapMatrixSize = 10**7
+
+# Two-sided empirical p-values of values among a reference sample. A value is in the central interval of level alpha,
+# from the int(alpha/2*N)-th smallest to the int(alpha/2*N)-th largest reference value, iff alpha is below its p-value.
+def getTwoSidedPValues(reference, values):
+	ref = np.sort(np.asarray(reference, dtype=float))
+	values = np.asarray(values, dtype=float)
+	# Largest number of reference values that can be trimmed from each side while keeping the value inside
+	nbTrimmed = np.minimum(np.searchsorted(ref, values, side='right') - 1, len(ref) - 1 - np.searchsorted(ref, values, side='left'))
+	return np.minimum(1.0, 2.0 * (nbTrimmed + 1) / len(ref))
+
+# Exact ROC curve of accepting the values whose score is above a threshold, for all thresholds.
+# Returns the fractions of accepted negative (false positives) and positive (true positives) values,
+# from the highest threshold (0, 0) to the lowest one (1, 1).
+def computeROC(posScores, negScores):
+	pos = np.sort(np.asarray(posScores, dtype=float))
+	neg = np.sort(np.asarray(negScores, dtype=float))
+	thresholds = np.unique(np.concatenate((pos, neg)))[::-1]
+	truePos = np.concatenate(([0.0], (len(pos) - np.searchsorted(pos, thresholds, side='left')) / len(pos)))
+	falsePos = np.concatenate(([0.0], (len(neg) - np.searchsorted(neg, thresholds, side='left')) / len(neg)))
+	return falsePos, truePos
+
+# Area under a ROC curve given by increasing false positive fractions
+def computeAUC(falsePos, truePos):
+	return float(np.sum(np.diff(falsePos) * (truePos[1:] + truePos[:-1]) / 2))
+
+# Returns the sorted rows of a matrix as a single sorted array, row i being shifted by i*offset, with offset
+# larger than the range of the values. Sorted values of row i can then be searched for x with x + i*offset.
+def getOffsetRows(sortedRows, offset):
+	return (sortedRows + offset * np.arange(len(sortedRows))[:, None]).ravel()
+
+# Bootstrap confidence bands of the ROC curve of posScores against negScores, at the false positive fractions of fpGrid.
+# Both samples are resampled nbBootstrap times at once, and the true positive fraction of each resampled curve is taken
+# at the highest acceptance threshold whose false positive fraction does not exceed each grid value.
+# Returns the grid, the mean, low and high true positive fractions and the AUC of each resampled curve.
+def bootstrapROC(posScores, negScores, nbBootstrap = 200, fpGrid = None, quantiles = (0.05, 0.95), rng = None):
+	rng = np.random.default_rng() if rng is None else rng
+	pos = np.asarray(posScores, dtype=float)
+	neg = np.asarray(negScores, dtype=float)
+	fpGrid = np.linspace(0, 1, 101) if fpGrid is None else np.asarray(fpGrid, dtype=float)
+	# Scores are mapped to ranks in the pooled sample, so that row offsets are simple to choose
+	pooled = np.unique(np.concatenate((pos, neg)))
+	pos = np.searchsorted(pooled, pos).astype(float)
+	neg = np.searchsorted(pooled, neg).astype(float)
+	offset = len(pooled) + 1
+	# Number of resampled negative values allowed above the threshold for each grid value
+	nbAllowed = np.floor(fpGrid * len(neg) + 1e-9).astype(int)
+
+	truePos = np.zeros((nbBootstrap, len(fpGrid)))
+	aucs = np.zeros(nbBootstrap)
+	chunkSize = max(1, maxBootstrapMatrixSize // (len(pos) + len(neg)))
+	for s in range(0, nbBootstrap, chunkSize):
+		e = min(nbBootstrap, s + chunkSize)
+		rowOffsets = offset * np.arange(e - s)[:, None]
+		posRows = np.sort(pos[rng.integers(len(pos), size = (e - s, len(pos)))], axis = 1)
+		negRows = np.sort(neg[rng.integers(len(neg), size = (e - s, len(neg)))], axis = 1)
+		posKeys = getOffsetRows(posRows, offset)
+		negKeys = getOffsetRows(negRows, offset)
+
+		# Values strictly above the (len(neg) - nbAllowed)-th smallest negative value are accepted
+		thrInds = len(neg) - nbAllowed - 1
+		thresholds = np.where(thrInds >= 0, negRows[:, np.maximum(thrInds, 0)], -1.0)
+		posRowStarts = len(pos) * np.arange(e - s)[:, None]
+		nbRejected = np.searchsorted(posKeys, thresholds + rowOffsets, side='right') - posRowStarts
+		truePos[s:e] = (len(pos) - nbRejected) / len(pos)
+
+		# AUC as the probability that a positive value is above a negative one, ties counting for one half
+		negRowStarts = len(neg) * np.arange(e - s)[:, None]
+		nbBelow = np.searchsorted(negKeys, posRows + rowOffsets, side='left') - negRowStarts
+		nbNotAbove = np.searchsorted(negKeys, posRows + rowOffsets, side='right') - negRowStarts
+		aucs[s:e] = np.sum(nbBelow + nbNotAbove, axis = 1) / (2.0 * len(pos) * len(neg))
+
+	res = TmpObject()
+	res.falsePos = fpGrid
+	res.mean = truePos.mean(axis = 0)
+	res.low, res.high = np.quantile(truePos, quantiles, axis = 0)
+	res.aucs = aucs
+	return res
@@ -1,5 +1,6 @@
 from Utilities import *
 from Simulations import *
+from multiprocess import cpu_count
 
 # Result analyzer ABC
 class ResultAnalyzer(AppParameterizable, InputOutput, ResultHolder):
@@ -9,11 +10,53 @@ class ResultAnalyzer(AppParameterizable, InputOutput, ResultHolder):
 		ResultHolder.__init__(self)
 		self._toUpdateOnModif = []
 
-	# Returns a new result object containing newly computed values
+	# Returns a new result object containing newly computed values. It can be run on a worker thread concurrently
+	# with other analyses, so it should not modify the analyzer: its state is set in ReuseResults.
 	@abstractmethod
 	def Analyze(self, results):
 		pass
 
+	# Overload this to return True if the outputs of Analyze only depend on the inputs and the analyzer parameters
+	def IsMemoizable(self):
+		return False
+
+	# Reference holders only select what is displayed, they are left out of the memoization key
+	def GetMemoKeyTuple(self):
+		return (type(self).__name__, self._getCachedFingerprint('memo', self._getMemoParamKeyTuple))
+
+	def _getMemoParamKeyTuple(self):
+		params = {name:getattr(self, name) for name in self.GetDefaultParams().description.keys() if not isinstance(getattr(self, name), ReferenceHolder)}
+		return Parameters(**params).GetKeyTuple()
+
+	# Overload this to return True if Analyze handles each producer of its inputs independently.
+	# It can then be run separately (and concurrently) for each producer, and only re-run for the ones that changed.
+	# Analyze should thus only build its outputs in a local Results object.
+	def IsAnalyzedPerSource(self):
+		return False
+
+	# Called from the main thread with the results of all elements once the analysis is done, whether its outputs
+	# were computed or memoized. Overload it to update the analyzer state from the results.
+	def ReuseResults(self, results, res):
+		self.SetResults(res)
+
+	# Overload this to return a function computing the outputs of Analyze for a single tree, to opt in for MapPerTree.
+	# It is run in other processes, so it should only depend on the tree and not rely on its modifications of the tree.
+	def GetPerTreeFunc(self):
+		return None
+
+	# Number of trees below which the per tree function is run serially
+	def GetParallelThreshold(self):
+		return 1000
+
+	# Applies the per tree function to all trees and returns the outputs in the order of the trees.
+	# Above the threshold, trees are processed in chunks on a process pool.
+	def MapPerTree(self, trees):
+		func = self.GetPerTreeFunc()
+		if len(trees) < self.GetParallelThreshold():
+			return [func(t) for t in trees]
+		with getProcessPool() as pool:
+			return pool.map(func, trees, chunksize = max(1, len(trees) // (4 * cpu_count())))
+
 	# Returns a list of class dependencies, other results analyzers or simulation runners
 	def DependsOn(self):
 		return []
@@ -48,11 +91,87 @@ import dendropy
 import plotly.graph_objs as go
 import dash_core_components as dcc
 from TreeUtilities import *
+from TreeIndex import *
 import numpy as np
 import copy
+import collections
+import threading
 
 RateNames = ['birth', 'death']
 
+# Returns the age of each node as the time elapsed since the start of the tree, without modifying the tree
+def getTreeAges(t):
+	index = getTreeIndex(t)
+	return dict(zip(index.nodes, index.GetTimes().tolist()))
+
+# Returns the birth and death events of the clade of the node of index i in the tree index
+def getRawRateData(index, i):
+	# TODO Find some way to auto-compute epsilon
+	epsilon = 0.00001
+	times = index.GetTimes()
+	clade = index.GetClade(i)
+	stTotTime = times[clade[index.isLeaf[clade]]].max()
+	# Same order as dendropy's ageorder_iter
+	events = clade[np.argsort(times[clade], kind='stable')]
+	events = events[stTotTime - times[events] > epsilon]
+	isDeath = index.isLeaf[events]
+	# Number of lineages before each event
+	nbLin = 1 + np.concatenate(([0], np.cumsum(np.where(isDeath, -1, 1))[:-1]))
+	rawRate = {}
+	for name, sel in zip(RateNames, [~isDeath, isDeath]):
+		rawRate[name] = TmpObject()
+		rawRate[name].time = times[events[sel]].tolist()
+		rawRate[name].rate = [1]*np.count_nonzero(sel)
+		rawRate[name].nbLin = nbLin[sel].tolist()
+	return rawRate
+
+# Returns the max time and the raw rates of a tree
+def treeRawRateFunc(t):
+	index = getTreeIndex(t)
+	return index.GetHeight(), getRawRateData(index, 0)
+
+# Minimum number of trees whose raw rates are kept by TreeVisualizer
+rateCacheSize = 16
+
+# Maximum number of kernel evaluations done at once by computeSmoothedRates
+maxKernelMatrixSize = 10**7
+
+# Smoothes the per lineage rates of several raw rate signals on a common time grid of nbSteps points.
+# Integral of kernel should be equal to 1, it has to accept numpy arrays.
+def computeSmoothedRates(signals, kernelFunc, maxTime, nbSteps = 100):
+	time = np.linspace(0, maxTime, num = nbSteps)
+	dt = time[1] - time[0] if nbSteps > 1 else 0
+
+	# Partial kernel integral over the time grid for border effect correction
+	kernInteg = kernelFunc(time[None, :] - time[:, None]).sum(axis = 1) * dt
+
+	# Events of all signals are concatenated, signal s holding events bounds[s] to bounds[s+1]
+	bounds = np.cumsum([0] + [len(sig.time) for sig in signals])
+	evTimes = np.concatenate([np.asarray(sig.time, dtype=float) for sig in signals] + [np.zeros(0)])
+	evWeights = np.concatenate([np.asarray(sig.rate, dtype=float) / np.asarray(sig.nbLin, dtype=float) for sig in signals] + [np.zeros(0)])
+
+	rates = np.zeros((len(signals), nbSteps))
+	i = 0
+	while i < len(signals):
+		# Process as many signals at once as the kernel matrix size allows
+		j = i + 1
+		while j < len(signals) and (bounds[j + 1] - bounds[i]) * nbSteps <= maxKernelMatrixSize:
+			j += 1
+		kernVals = kernelFunc(evTimes[None, bounds[i]:bounds[j]] - time[:, None]) * evWeights[None, bounds[i]:bounds[j]]
+		# Sums over the events of each signal, from cumulative sums over all events
+		cumSums = np.concatenate((np.zeros((nbSteps, 1)), np.cumsum(kernVals, axis = 1)), axis = 1)
+		rates[i:j] = (cumSums[:, bounds[i + 1:j + 1] - bounds[i]] - cumSums[:, bounds[i:j] - bounds[i]]).T
+		i = j
+	rates /= kernInteg
+
+	allRes = []
+	for rate in rates:
+		res = TmpObject()
+		res.time = time
+		res.rate = rate
+		allRes.append(res)
+	return allRes
+
 class TreeVisualizer(ResultAnalyzer, DashInterfacable):
 	def __init__(self):
 		ResultAnalyzer.__init__(self)
@@ -60,12 +179,30 @@ class TreeVisualizer(ResultAnalyzer, DashInterfacable):
 
 		self._setCustomLayout('params', DashHorizontalLayout())
 		self.smoothedRate = {name:{} for name in RateNames}
+		self._initRateCache()
+
+	# Raw rates are computed when a tree is first displayed and kept in a LRU cache keyed on (source, treeId)
+	def _initRateCache(self):
+		self._rateCache = collections.OrderedDict()
+		self._rateCacheLock = threading.Lock()
+
+	# The cache and its lock are not pickled
+	def __getstate__(self):
+		state = ResultAnalyzer.__getstate__(self)
+		del state['_rateCache']
+		del state['_rateCacheLock']
+		return state
+
+	def __setstate__(self, state):
+		ResultAnalyzer.__setstate__(self, state)
+		self._initRateCache()
 
 	def GetDefaultParams(self):
 		dct = {
 			'treeId' : (0, int),
 			'rateToDisplay': ('birth', str, ['birth', 'death']),
 			'filterWidth': (0.05,),
+			'nbPrefetch': (0, int),
 			'source' : self._getInputReferenceParam('trees')
 		}
 		return ParametersDescr(dct)
@@ -73,90 +210,56 @@ class TreeVisualizer(ResultAnalyzer, DashInterfacable):
 	def GetInputs(self):
 		return ['trees']
 
+	def IsAnalyzedPerSource(self):
+		return True
+
 	def Analyze(self, results):
-		self.results = Results(self)
+		res = Results(self)
 		if not results.HasAttr('trees'):
-			return self.results
-
-		self.results.addResults(results)
-		res = self.results
-		for ownedTrees in results.GetOwnedAttr('trees'):
-			with ownedTrees:
-				trees = ownedTrees.GetValue()
-				mtKey = id(ownedTrees.owner)
-
-				ageFunc = lambda t: (lambda n: (t.seed_node.edge.length if t.seed_node.edge.length is not None else 0) + n.root_distance)
-
-				res.rawRate = {name:[] for name in RateNames}
-				res.maxTimes = []
-				for i, t in enumerate(trees):
-					t.calc_node_root_distances()
-					t.calc_node_ages(set_node_age_fn = ageFunc(t))
-					res.maxTimes.append(max(nd.age for nd in t))
-					self._fillRawRateData(t.seed_node, res)
+			return res
 
+		# Raw rates are only computed for the displayed trees, see _getTreeRawRate
+		res.addResults(results)
 		res.selectedTree = self.treeId
 		res.selectedSource = self.source
 		return res
 
-	def _fillRawRateData(self, node, res):
-		# TODO Find some way to auto-compute epsilon
-		epsilon = 0.00001
-		stTotTime = max(nd.age for nd in node.leaf_nodes())
-		sigs = TmpObject()
-		sigs.time = []
-		sigs.rate = []
-		sigs.nbLin = []
-		res.rawRate['birth'].append(sigs)
-		res.rawRate['death'].append(copy.deepcopy(sigs))
-		tmpNbLin = 1
-		for n in node.ageorder_iter(include_leaves = True):
-			if stTotTime - n.age > epsilon:
-				if n.is_leaf():
-					res.rawRate['death'][-1].time.append(n.age)
-					res.rawRate['death'][-1].rate.append(1)
-					res.rawRate['death'][-1].nbLin.append(tmpNbLin)
-					tmpNbLin -= 1
-				else:
-					res.rawRate['birth'][-1].time.append(n.age)
-					res.rawRate['birth'][-1].rate.append(1)
-					res.rawRate['birth'][-1].nbLin.append(tmpNbLin)
-					tmpNbLin += 1
+	# Returns the max time and the raw rates of a tree, computed on first access
+	def _getTreeRawRate(self, source, trees, treeId):
+		key = (source, treeId)
+		with self._rateCacheLock:
+			entry = self._rateCache.get(key)
+			# Entries computed from a previous simulation of the source are ignored
+			if entry is not None and entry[0] is trees:
+				self._rateCache.move_to_end(key)
+				return entry[1]
+		value = treeRawRateFunc(trees[treeId])
+		with self._rateCacheLock:
+			self._rateCache[key] = (trees, value)
+			self._rateCache.move_to_end(key)
+			while len(self._rateCache) > max(rateCacheSize, 2 * self.nbPrefetch + 1):
+				self._rateCache.popitem(last = False)
+		return value
+
+	# Computes the raw rates of the nbPrefetch trees before and after the displayed one in a background thread
+	def _prefetchRawRates(self, source, trees):
+		with self._rateCacheLock:
+			toFetch = [i for i in range(self.treeId - self.nbPrefetch, self.treeId + self.nbPrefetch + 1)
+				if 0 <= i < len(trees) and i != self.treeId and not ((source, i) in self._rateCache and self._rateCache[(source, i)][0] is trees)]
+		if len(toFetch) > 0:
+			threading.Thread(target = lambda: [self._getTreeRawRate(source, trees, i) for i in toFetch], daemon = True).start()
 
 	# Integral of kernel should be equal to 1
 	def _computeSmoothedRate(self, signal, kernelFunc, maxTime, nbSteps = 100):
-		res = TmpObject()
-		res.time = np.linspace(0, maxTime, num = nbSteps)
-
-		# Compute partial kernel integral for border effect correction
-		dt = res.time[1]-res.time[0]
-		kernInteg = [sum(kernelFunc(t-res.time[0]) for t in res.time)*dt]
-		for i, t in enumerate(res.time[1:]):
-			kernInteg.append(kernInteg[-1] + dt *(-kernelFunc((nbSteps-1-i)*dt) + kernelFunc(-(i+1)*dt)))
-
-		res.rate = []
-		for j, t in enumerate(res.time):
-			tmp = 0
-			for i, t2 in enumerate(signal.time):
-				kv = kernelFunc(t2-t)
-				tmp += kv * signal.rate[i] / signal.nbLin[i]
-			res.rate.append(tmp / kernInteg[j])
-		return res
+		return computeSmoothedRates([signal], kernelFunc, maxTime, nbSteps)[0]
 
 	def _updateTrees(self):
-		ownedTrees = self.results.GetOwnedAttr('trees', lambda oah: oah.owner == self.source.value)
+		ownedTrees = self.results.GetOwnedAttr('trees', owner=self.source.value)
 		if len(ownedTrees) > 0:
 			self.trees = ownedTrees[0].GetValue()
-
-			ownedMaxTimes = self.results.GetOwnedAttr('maxTimes', lambda oah: ownedTrees[0] in oah.sources)
-			if  len(ownedMaxTimes) > 0:
-				maxTimes = ownedMaxTimes[0].GetValue()
-				if self.treeId < len(maxTimes):
-					self.selectedMaxTime = maxTimes[self.treeId]
-
-			rawRates = self.results.GetOwnedAttr('rawRate', lambda oah: ownedTrees[0] in oah.sources)
-			if len(rawRates) > 0:
-				self.selectedRawRate = rawRates[0].GetValue()
+			if self.treeId < len(self.trees):
+				self.selectedMaxTime, self.selectedRawRate = self._getTreeRawRate(ownedTrees[0].owner, self.trees, self.treeId)
+				self._prefetchRawRates(ownedTrees[0].owner, self.trees)
 			else:
 				self.selectedRawRate = None
 		else:
@@ -199,27 +302,30 @@ class TreeVisualizer(ResultAnalyzer, DashInterfacable):
 		else:
 			sigma = self.selectedMaxTime * self.filterWidth
 			kernel = lambda d: np.exp(-0.5*(d/sigma)**2)/(sigma*(2*np.pi)**0.5)
-			for name in RateNames:
-				self.smoothedRate[name][self.treeId] = self._computeSmoothedRate(self.selectedRawRate[name][self.treeId], kernel, self.selectedMaxTime)
+			signals = [self.selectedRawRate[name] for name in RateNames]
+			if selectedClade is not None:
+				tree = self.trees[self.treeId]
+				cladeRawRate = getRawRateData(getTreeIndex(tree), selectedClade)
+				signals += [cladeRawRate[name] for name in RateNames]
+			# Tree and clade rates are smoothed together
+			smoothed = computeSmoothedRates(signals, kernel, self.selectedMaxTime)
+			for name, sm in zip(RateNames, smoothed):
+				self.smoothedRate[name][self.treeId] = sm
 
 			allTraces = []
 			if selectedClade is not None:
-				res = TmpObject()
-				res.rawRate = {name:[] for name in RateNames}
-				self._fillRawRateData(self.trees[self.treeId].nodes()[selectedClade], res)
-				smoothedCladeBirth = self._computeSmoothedRate(res.rawRate['birth'][0], kernel, self.selectedMaxTime)
-				smoothedCladeDeath = self._computeSmoothedRate(res.rawRate['death'][0], kernel, self.selectedMaxTime)
+				smoothedCladeBirth, smoothedCladeDeath = smoothed[len(RateNames):]
 				allTraces.append(go.Scatter(x = smoothedCladeBirth.time, y=smoothedCladeBirth.rate, 
 					mode='lines', line=dict(color='green', dash='dash'), name='clade birth rate'))
 				allTraces.append(go.Scatter(x = smoothedCladeDeath.time, y=smoothedCladeDeath.rate, 
 					mode='lines', line=dict(color='red', dash='dash'), name='clade death rate'))
 
-			allTraces.append(go.Scatter(x = self.selectedRawRate['birth'][self.treeId].time, y=[0]*len(self.selectedRawRate['birth'][self.treeId].rate), 
+			allTraces.append(go.Scatter(x = self.selectedRawRate['birth'].time, y=[0]*len(self.selectedRawRate['birth'].rate), 
 				mode='markers', marker=dict(color='green'), hoverinfo='none', showlegend=False))
 			allTraces.append(go.Scatter(x = self.smoothedRate['birth'][self.treeId].time, y=self.smoothedRate['birth'][self.treeId].rate, 
 				mode='lines', line=dict(color='green'), name='birth rate'))
 
-			allTraces.append(go.Scatter(x = self.selectedRawRate['death'][self.treeId].time, y=[0]*len(self.selectedRawRate['death'][self.treeId].rate), 
+			allTraces.append(go.Scatter(x = self.selectedRawRate['death'].time, y=[0]*len(self.selectedRawRate['death'].rate), 
 				mode='markers', marker=dict(color='red'), hoverinfo='none', showlegend=False))
 			allTraces.append(go.Scatter(x = self.smoothedRate['death'][self.treeId].time, y=self.smoothedRate['death'][self.treeId].rate, 
 				mode='lines', line=dict(color='red'), name='death rate'))
@@ -259,8 +365,59 @@ class TreeVisualizer(ResultAnalyzer, DashInterfacable):
 			])(self._getCladeSelectionCallback())
 
 from WComputations import *
+from Summaries import *
 from plotly.colors import DEFAULT_PLOTLY_COLORS
 
+# Initial bin size of branch length histograms, they are all derived from it so that they can be merged
+blenBaseBinSize = 2.0**-20
+# Quantiles delimiting the bands drawn around the mean distributions of an ensemble
+bandQuantiles = (0.05, 0.95)
+
+# Returns the traces drawing a mean curve and a band between low and high, in the color of a source
+def getBandTraces(x, low, high, mean, color, legendName):
+	bandColor = color.replace('rgb', 'rgba').replace(')', ',0.2)')
+	return [
+		go.Scatter(x=x, y=low, mode='lines', line=dict(width=0), hoverinfo='none', showlegend=False, legendgroup=legendName),
+		go.Scatter(x=x, y=high, mode='lines', line=dict(width=0), fill='tonexty', fillcolor=bandColor, hoverinfo='none', showlegend=False, legendgroup=legendName),
+		go.Scatter(x=x, y=mean, mode='lines', line=dict(color=color), legendgroup=legendName, name=legendName)
+	]
+
+# Per tree function of TreeStatAnalyzer, returns the statistics and histograms of a tree
+def treeStatFunc(t, nbBins = 20):
+	stats = ComputeTreeStats(t)
+	colless_t = stats.colless if stats.nbLeaves > 3 else None
+	return colless_t, stats.sackin, getCladeSizeHist(stats, nbBins), getBranchLengthHist(stats, nbBins)
+
+# Histogram of clade sizes divided by the number of leaves, over a binning shared by all trees
+def getCladeSizeHist(stats, nbBins):
+	nb_leaves_t = stats.nbLeaves
+	hist = FixedHistogram(nbBins, 1.0 / nbBins)
+	hist.Add(np.arange(nb_leaves_t + 1) / nb_leaves_t, stats.cladeSizes / nb_leaves_t)
+	return hist
+
+# Histogram of branch lengths, that can be merged with the ones of other trees
+def getBranchLengthHist(stats, nbBins):
+	hist = FixedHistogram(nbBins, blenBaseBinSize, growable = True)
+	hist.Add(stats.edgeLengths)
+	return hist
+
+# Detailed clade size distribution of a single tree as (x, y, hover text, bin size), with the bins and the normalization of an ensemble
+def getCladeSizeDetail(stats, bands):
+	hist = getCladeSizeHist(stats, bands.nbBins).CoarsenedTo(bands.binSize)
+	clade_sizes_text = []
+	for i, clade_size_i in enumerate(hist.counts):
+		clade_sizes_text.append("Relative clade size: [" + '{0:.3g}'.format(i*hist.binSize) + "," + '{0:.3g}'.format((i+1)*hist.binSize) + "); Amount: " + '{0:.3g}'.format(clade_size_i))
+	return hist.GetCenters(), hist.counts, clade_sizes_text, hist.binSize
+
+# Detailed branch length distribution of a single tree as (x, y, hover text, bin size), with the bins of an ensemble
+def getBranchLengthDetail(stats, bands):
+	hist = getBranchLengthHist(stats, bands.nbBins).CoarsenedTo(bands.binSize)
+	blen_max_y = hist.GetTotal()
+	blen_text = []
+	for i, branch_lenghts_i in enumerate(hist.counts):
+		blen_text.append("Branch length: [" + '{0:.3g}'.format(i*hist.binSize) + "," + '{0:.3g}'.format((i+1)*hist.binSize) + "); Amount: " + str(int(branch_lenghts_i)))
+	return hist.GetCenters(), hist.counts / blen_max_y, blen_text, hist.binSize
+
 class TreeStatAnalyzer(ResultAnalyzer, DashInterfacable):
 	def __init__(self):
 		ResultAnalyzer.__init__(self)
@@ -269,6 +426,8 @@ class TreeStatAnalyzer(ResultAnalyzer, DashInterfacable):
 		self.selectedTree = None
 		self.selectedSource = None
 		self.treeVis = None
+		# Producer -> analyzed trees, to show the details of the selected tree
+		self.inputTrees = {}
 
 	def DependsOn(self):
 		return [TreeStatSimulation]
@@ -276,87 +435,73 @@ class TreeStatAnalyzer(ResultAnalyzer, DashInterfacable):
 	def GetInputs(self):
 		return ['trees']
 
+	def GetDefaultParams(self):
+		return ParametersDescr({
+			'nbBins' : (20, int)
+		})
+
 	def GetOutputs(self):
-		return ['colless_tree_imba', 'sackin_index', 'clade_sizes', 'branch_lenghts']
+		return ['colless_tree_imba', 'sackin_index', 'clade_size_hist', 'branch_length_hist',
+			'colless_sketch', 'sackin_sketch', 'clade_size_bands', 'branch_length_bands']
 	
-	def Analyze(self, results):
-		self.results = Results(self)
+	def IsMemoizable(self):
+		return True
+
+	def IsAnalyzedPerSource(self):
+		return True
+
+	def ReuseResults(self, results, res):
+		self._updateSelection(results)
+		ResultAnalyzer.ReuseResults(self, results, res)
+
+	def GetPerTreeFunc(self):
+		nbBins = self.nbBins
+		return lambda t: treeStatFunc(t, nbBins)
 
+	def _updateSelection(self, results):
 		self.selectedTree = results.GetOwnedAttr('selectedTree', ind=0, defVal=None)
 		self.selectedSource = results.GetOwnedAttr('selectedSource', ind=0, defVal=None)
+		self.inputTrees = {ownedTrees.owner:ownedTrees.GetValue() for ownedTrees in results.GetOwnedAttr('trees')}
+
+	def Analyze(self, results):
+		res = Results(self)
 
 		for ownedTrees in results.GetOwnedAttr('trees'):
 			with ownedTrees:
 				trees = ownedTrees.GetValue()
-				self.results.colless_tree_imba = []
-				self.results.sackin_index = []
-				#self.results.W = []
-				self.results.clade_sizes = []
-				self.results.branch_lenghts = []
-
-				for t in trees:
-					nb_leaves_t = len(t.leaf_nodes())
-					if nb_leaves_t > 3:
-						self.results.colless_tree_imba.append(dendropy.calculate.treemeasure.colless_tree_imbalance(t))
-					else:
-						self.results.colless_tree_imba.append(None)
-					self.results.sackin_index.append(dendropy.calculate.treemeasure.sackin_index(t))
-
-					#self.results.W.append(computeW(t, t.seed_node))
-
-					# Clade size distribution
-					clade_sizes_t = [0]*(nb_leaves_t+1)
-					for n in t.nodes():
-						clade_sizes_t[len(n.leaf_nodes())] += 1
-					# Compute additional information for clade size distribution (caption and normalization)
-					clade_sizes_x_norm = []
-					clade_sizes_y_norm = []
-					clade_sizes_text   = []
-					# Re-scale x-axis btw 0 and 1
-					a = 1 / nb_leaves_t
-					#clade_sizes_binsize = 1.0/nb_leaves_t
-					clade_sizes_binsize = a
-					for i, clade_size_i in enumerate(clade_sizes_t):
-						x_norm = a*i
-						#clade_sizes_x_norm.append(i/float(nb_leaves_t))
-						clade_sizes_x_norm.append(x_norm)
-						clade_sizes_y_norm.append(clade_size_i/float(nb_leaves_t))
-						clade_sizes_text.append("Clade Size: " + str(i) + "; Amount: " + str(clade_size_i) + "; " + str(i/float(nb_leaves_t)))
-					# Warning: Without this, Plotly attributes the captions incorrectly. Why? It's a Christmas mystery!	
-					del(clade_sizes_text[0])
-					self.results.clade_sizes.append((clade_sizes_x_norm, clade_sizes_y_norm, clade_sizes_text, clade_sizes_binsize))
-					
-					#clade_sizes_t=[]
-					#for n in t.nodes():
-					#	clade_sizes_t.append(len(n.leaf_nodes()))
-					#self.results.clade_sizes.append(clade_sizes_t)
-
-					# Branch lenght distribution
-					branch_lenghts_t = [n.edge_length for n in t.nodes()]
-					blen_min     = min(branch_lenghts_t)
-					blen_max     = max(branch_lenghts_t)
-					blen_nb_bins = 20 # TODO: Adjust number of bins according to the size of the trees (more resolution to bigger trees)
-					blen_binsize = (blen_max - blen_min + 1) / float(blen_nb_bins)
-					branch_lenghts_t = [0]*(blen_nb_bins)
-					for n in t.nodes():
-						idx_n = int(n.edge_length / blen_binsize)
-						branch_lenghts_t[idx_n] += 1
-					# Compute additional information for branch lenght distribution
-					blen_max_y  = len(t.nodes())
-					blen_x_norm = []
-					blen_y_norm = []
-					blen_text   = []
-					for i, branch_lenghts_i in enumerate(branch_lenghts_t):
-						blen_x_norm.append(i)
-						blen_y_norm.append(branch_lenghts_i/float(blen_max_y))
-						blen_text.append("Branch length: [" + '{0:.3g}'.format(i*blen_binsize) + "," + '{0:.3g}'.format((i+1)*blen_binsize) + "); Amount: " + str(branch_lenghts_i))
-					self.results.branch_lenghts.append((blen_x_norm, blen_y_norm, blen_text, 1))
-
-					# Distance between MRCA and root
-					#nb
-
-						
-		return self.results
+				res.colless_tree_imba = []
+				res.sackin_index = []
+				#res.W = []
+				# Fixed memory summaries of the whole ensemble
+				clade_size_hist = FixedHistogram(self.nbBins, 1.0 / self.nbBins)
+				branch_length_hist = FixedHistogram(self.nbBins, blenBaseBinSize, growable = True)
+				colless_sketch = QuantileSketch()
+				sackin_sketch = QuantileSketch()
+
+				perTree = self.MapPerTree(trees)
+				for colless_t, sackin_t, clade_size_hist_t, branch_length_hist_t in perTree:
+					res.colless_tree_imba.append(colless_t)
+					res.sackin_index.append(sackin_t)
+					clade_size_hist.Merge(clade_size_hist_t)
+					branch_length_hist.Merge(branch_length_hist_t)
+					colless_sketch.Add(colless_t)
+					sackin_sketch.Add(sackin_t)
+
+				# The final branch length binning is only known once all trees are merged
+				clade_size_bands = HistogramBands(self.nbBins, clade_size_hist.binSize)
+				branch_length_bands = HistogramBands(self.nbBins, branch_length_hist.binSize)
+				for colless_t, sackin_t, clade_size_hist_t, branch_length_hist_t in perTree:
+					clade_size_bands.Add(clade_size_hist_t)
+					branch_length_bands.Add(branch_length_hist_t, branch_length_hist_t.GetTotal())
+
+				res.clade_size_hist = clade_size_hist
+				res.branch_length_hist = branch_length_hist
+				res.colless_sketch = colless_sketch
+				res.sackin_sketch = sackin_sketch
+				res.clade_size_bands = clade_size_bands
+				res.branch_length_bands = branch_length_bands
+
+		return res
 	
 	def DefaultUpdateOnModif(self):
 		return [TreeVisualizer]
@@ -367,45 +512,47 @@ class TreeStatAnalyzer(ResultAnalyzer, DashInterfacable):
 			self.selectedSource = source.source
 			self.treeVis = source
 
+	# Returns the statistics of the tree selected in TreeVisualizer, or None
+	def _getSelectedTreeStats(self):
+		if self.selectedTree is None or self.selectedSource is None:
+			return None
+		trees = self.inputTrees.get(self.selectedSource.value)
+		if trees is None or self.selectedTree >= len(trees):
+			return None
+		return ComputeTreeStats(trees[self.selectedTree])
+
 	def _getInnerLayout(self):
 
 		allFigures = []
 		opacity = 0.75
 
-		stats_dist = [('clade_sizes', 'Clade Size Distribution'),
-					('branch_lenghts', 'Branch Length Distribution')]
+		stats_dist = [('clade_size_bands', 'Clade Size Distribution', getCladeSizeDetail),
+					('branch_length_bands', 'Branch Length Distribution', getBranchLengthDetail)]
 
-		for key, name in stats_dist:
+		# Distributions are aggregated per source, only the selected tree is shown in details
+		selectedStats = self._getSelectedTreeStats()
+		for key, name, detailFunc in stats_dist:
 			data = []
-			shapes = []
-			
-			#colors = ['hsl('+str(h)+',50%'+',50%)' for h in np.linspace(0, 360, len(self.results.GetOwnedAttr(key))+1)]
-			max_dist_x = -math.inf
-			min_dist_x = math.inf
 			for idx, owned in enumerate(self.results.GetOwnedAttr(key)):
 				with owned:
-					distributions = owned.GetValue()
-					partial_opacity = max(0.05, (1.0/len(distributions))*opacity if len(distributions) > 0 else opacity)
+					bands = owned.GetValue()
+					color = DEFAULT_PLOTLY_COLORS[idx%10]
 					legendName = owned.GetFullSourceName(layersToPeel=1)
-					# Warning: Improvised solution to have the caption displaying a proper color
-					data.append(dict(x=[1], y=[0], type='scatter', opacity=opacity, marker=dict(color=DEFAULT_PLOTLY_COLORS[idx%10]), hoverinfo='none', showlegend=True, legendgroup=legendName, name = legendName))
-					for dist_x, dist_y, dist_text, dist_binsize in distributions:
-						filt = [x for x,y in zip(dist_x, dist_y) if y > 0]
-						max_dist_x = max(max(filt)+dist_binsize/2,max_dist_x)
-						min_dist_x = min(min(filt)-dist_binsize/2,min_dist_x)
-						data.append(go.Histogram(histfunc = "sum", x=dist_x, y=dist_y, text=dist_text, opacity=partial_opacity, marker=dict(color=DEFAULT_PLOTLY_COLORS[idx%10]), xbins=dict(size=dist_binsize), showlegend=False, legendgroup=legendName, name = legendName))	
+					data += getBandTraces(bands.GetCenters(), bands.GetQuantiles(bandQuantiles[0]), bands.GetQuantiles(bandQuantiles[1]), bands.GetMeans(), color, legendName)
+					if selectedStats is not None and self.selectedSource.value in owned.GetAllSources():
+						dist_x, dist_y, dist_text, dist_binsize = detailFunc(selectedStats, bands)
+						data.append(go.Bar(x=dist_x, y=dist_y, text=dist_text, width=dist_binsize, opacity=opacity, marker=dict(color=color), showlegend=False, name='Selected tree'))
 
 			allFigures.append(
 				dcc.Graph(figure=dict(
 					data=data, 
 					layout=go.Layout(
-						xaxis=dict(title=name, range=(min_dist_x, max_dist_x)),
+						xaxis=dict(title=name),
 						yaxis=dict(title='Count'), 
 						margin=dict(l=40,b=30,t=10,r=0), 
 						hovermode='closest', 
 						barmode='overlay',
-						legend=dict(x=0.05,y=0.95),
-						shapes=shapes)
+						legend=dict(x=0.05,y=0.95))
 					)
 				)
 			)
@@ -494,3 +641,203 @@ class TreeStatAnalyzer(ResultAnalyzer, DashInterfacable):
 	#			Input(self._getElemId('innerLayout', 'treeGraph'), 'figure')
 	#		])(self._getCladeSelectionCallback())
 
+
+# Returns a copy of a raw rate signal with event times divided by maxTime
+def scaleSignal(signal, maxTime):
+	res = TmpObject()
+	res.time = np.asarray(signal.time, dtype=float) / maxTime
+	res.rate = signal.rate
+	res.nbLin = signal.nbLin
+	return res
+
+# Returns the number of lineages of each tree at each time of the grid, from their raw rates and their max times.
+# Events of all trees are searched at once, events of tree i being shifted to relative times in [2i, 2i+1].
+def computeLTT(rawRates, maxTimes, time):
+	nbTrees = len(rawRates)
+	offsets = 2 * np.arange(nbTrees)
+	ltt = np.ones((nbTrees, len(time)))
+	for name, sign in [('birth', 1), ('death', -1)]:
+		times = [np.asarray(rawRate[name].time, dtype=float) / maxTime for rawRate, maxTime in zip(rawRates, maxTimes)]
+		keys = np.sort(np.concatenate(times + [np.zeros(0)]) + np.repeat(offsets, [len(t) for t in times]))
+		nbBefore = np.searchsorted(keys, time[None, :] + offsets[:, None], side='right')
+		ltt += sign * (nbBefore - np.searchsorted(keys, offsets, side='left')[:, None])
+	return ltt
+
+# Returns the mean and the band quantiles over trees (rows) of curves sampled on a time grid
+def getEnsembleBands(time, values):
+	res = TmpObject()
+	res.time = time
+	res.mean = values.mean(axis = 0)
+	res.low, res.high = np.quantile(values, bandQuantiles, axis = 0)
+	return res
+
+# Smoothed per lineage birth and death rates and lineages through time of all trees, reduced to mean and bands per source.
+# Time is relative to the height of each tree, so that trees of different heights share the same time grid.
+class RateThroughTimeAnalyzer(ResultAnalyzer, DashInterfacable):
+	def __init__(self):
+		ResultAnalyzer.__init__(self)
+		DashInterfacable.__init__(self)
+
+	def GetDefaultParams(self):
+		return ParametersDescr({
+			'filterWidth': (0.05,),
+			'nbSteps': (100, int)
+		})
+
+	def DependsOn(self):
+		return [TreeStatSimulation]
+
+	def GetInputs(self):
+		return ['trees']
+
+	def GetOutputs(self):
+		return ['birth_rate_bands', 'death_rate_bands', 'ltt_bands']
+
+	def IsMemoizable(self):
+		return True
+
+	def IsAnalyzedPerSource(self):
+		return True
+
+	# Uses the same raw rate extraction as TreeVisualizer
+	def GetPerTreeFunc(self):
+		return treeRawRateFunc
+
+	def Analyze(self, results):
+		res = Results(self)
+		for ownedTrees in results.GetOwnedAttr('trees'):
+			with ownedTrees:
+				trees = ownedTrees.GetValue()
+				if len(trees) == 0:
+					continue
+				perTree = self.MapPerTree(trees)
+				maxTimes = np.array([maxTime for maxTime, rawRate in perTree])
+				rawRates = [rawRate for maxTime, rawRate in perTree]
+				time = np.linspace(0, 1, num = self.nbSteps)
+
+				sigma = self.filterWidth
+				kernel = lambda d: np.exp(-0.5*(d/sigma)**2)/(sigma*(2*np.pi)**0.5)
+				allBands = {}
+				for name in RateNames:
+					smoothed = computeSmoothedRates([scaleSignal(rawRate[name], maxTime) for rawRate, maxTime in zip(rawRates, maxTimes)], kernel, 1, self.nbSteps)
+					# Back to rates per unit of time of each tree
+					rates = np.array([sm.rate for sm in smoothed]) / maxTimes[:, None]
+					allBands[name] = getEnsembleBands(time, rates)
+				res.birth_rate_bands = allBands['birth']
+				res.death_rate_bands = allBands['death']
+				res.ltt_bands = getEnsembleBands(time, computeLTT(rawRates, maxTimes, time))
+
+		return res
+
+	def _getInnerLayout(self):
+		allFigures = []
+		for key, name in [('birth_rate_bands', 'Birth rate'), ('death_rate_bands', 'Death rate'), ('ltt_bands', 'Lineages')]:
+			data = []
+			for idx, owned in enumerate(self.results.GetOwnedAttr(key)):
+				with owned:
+					bands = owned.GetValue()
+					data += getBandTraces(bands.time, bands.low, bands.high, bands.mean, DEFAULT_PLOTLY_COLORS[idx%10], owned.GetFullSourceName(layersToPeel=1))
+
+			allFigures.append(
+				dcc.Graph(figure=dict(
+					data=data, 
+					layout=go.Layout(
+						xaxis=dict(title='Relative time'), 
+						yaxis=dict(title=name), 
+						margin=dict(l=40,b=30,t=10,r=0), 
+						hovermode='closest', 
+						legend=dict(x=0.05,y=0.95))
+					)
+				)
+			)
+
+		return DashGridLayout(columns = len(allFigures)).GetLayout(allFigures, style={'border-style':'solid', 'border-width':'1px', 'background-color':'rgb(200,200,200)'})
+
+# Per tree function of W2SurrogateAnalyzer, returns the W2 scores and the Bernoulli surrogate p-values
+# of all clades (except the whole tree) with at least minCladeSize leaves
+def treeW2SurrogateFunc(t, minCladeSize, nbReplicates):
+	index = getTreeIndex(t)
+	cladeInds = np.flatnonzero(~index.isLeaf & (index.leafCounts >= minCladeSize))
+	clades = [index.nodes[i] for i in cladeInds.tolist() if i > 0]
+	rng = np.random.default_rng()
+	scores = []
+	pVals = []
+	# Ages are counted from the present, the trees can have extinct lineages
+	for num, den, pis in iterW2Batch(t, clades, ages = index.GetPresentAges()):
+		w2 = num / math.sqrt(den) if den > 0 else 0
+		scores.append(w2)
+		pVals.append(getSurrogatePValue(w2, drawBernoulliW2(pis, nbReplicates, rng)))
+	return np.array(scores), np.array(pVals)
+
+# W2 scores of the clades of all trees and their p-values under the Bernoulli surrogate, whose distribution
+# should be uniform for neutral trees
+class W2SurrogateAnalyzer(ResultAnalyzer, DashInterfacable):
+	def __init__(self):
+		ResultAnalyzer.__init__(self)
+		DashInterfacable.__init__(self)
+
+	def GetDefaultParams(self):
+		return ParametersDescr({
+			'minCladeSize': (5, int),
+			'nbReplicates': (1000, int),
+			'nbBins': (20, int)
+		})
+
+	def DependsOn(self):
+		return [TreeStatSimulation]
+
+	def GetInputs(self):
+		return ['trees']
+
+	def GetOutputs(self):
+		return ['w2_scores', 'w2_pvalues', 'w2_pvalue_hist']
+
+	def IsMemoizable(self):
+		return True
+
+	def IsAnalyzedPerSource(self):
+		return True
+
+	def GetPerTreeFunc(self):
+		minCladeSize = self.minCladeSize
+		nbReplicates = self.nbReplicates
+		return lambda t: treeW2SurrogateFunc(t, minCladeSize, nbReplicates)
+
+	def Analyze(self, results):
+		res = Results(self)
+		for ownedTrees in results.GetOwnedAttr('trees'):
+			with ownedTrees:
+				perTree = self.MapPerTree(ownedTrees.GetValue())
+				res.w2_scores = np.concatenate([scores for scores, pVals in perTree] + [np.zeros(0)])
+				res.w2_pvalues = np.concatenate([pVals for scores, pVals in perTree] + [np.zeros(0)])
+				hist = FixedHistogram(self.nbBins, 1.0 / self.nbBins)
+				hist.Add(res.w2_pvalues)
+				res.w2_pvalue_hist = hist
+
+		return res
+
+	def _getInnerLayout(self):
+		data = []
+		for idx, owned in enumerate(self.results.GetOwnedAttr('w2_pvalue_hist')):
+			with owned:
+				hist = owned.GetValue()
+				total = hist.GetTotal()
+				data.append(go.Scatter(
+					x=hist.GetCenters(), 
+					y=hist.counts / total if total > 0 else hist.counts, 
+					mode='lines+markers', 
+					line=dict(color=DEFAULT_PLOTLY_COLORS[idx%10]), 
+					name=owned.GetFullSourceName(layersToPeel=1)))
+		if len(data) > 0:
+			data.append(go.Scatter(x=[0, 1], y=[1.0 / self.nbBins]*2, mode='lines', line=dict(color='black', dash='dash'), name='Uniform'))
+
+		return dcc.Graph(figure=dict(
+			data=data, 
+			layout=go.Layout(
+				xaxis=dict(title='Bernoulli surrogate p-value of W2'), 
+				yaxis=dict(title='Fraction of clades'), 
+				margin=dict(l=40,b=30,t=10,r=0), 
+				hovermode='closest', 
+				legend=dict(x=0.05,y=0.95))
+			)
+		)
@@ -2,47 +2,170 @@ import dill as pickle
 import os
 from Utilities import *
 import copy
+import tempfile
+import threading
+try:
+	import fcntl
+except ImportError:
+	# No advisory file locking (e.g. on Windows), the simulation file is then only safe for a single process
+	fcntl = None
 
+# Exclusive inter-process lock held on a file, to be used in a with statement
+class FileLock:
+	def __init__(self, path):
+		self.path = path
+		self.file = None
+
+	def __enter__(self):
+		self.file = open(self.path, 'a')
+		if fcntl is not None:
+			fcntl.flock(self.file, fcntl.LOCK_EX)
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if fcntl is not None:
+			fcntl.flock(self.file, fcntl.LOCK_UN)
+		self.file.close()
+		self.file = None
+
+# Memoizes simulation results in a file that can be shared by several processes
 class SimulationManager:
 	def __init__(self, fname = 'Simulations.pkl'):
 		self.fname = fname
-		if os.path.isfile(fname):
-			try:
-				with open(fname, 'rb') as f:
-					self.simulations = pickle.load(f)
-			except:
-				raise Warning('')
-				self.simulations = {}
-		else:
-			self.simulations = {}
+		self.lockFolder = fname + '.locks'
+		self.simulations = {}
+		# Keys that were modified locally but not saved yet
+		self._dirtyKeys = set()
+		# (mtime, size) of the simulation file at the time it was last loaded
+		self._loadedStamp = None
+		# Protects the in-memory state when simulations and analyses run in several threads
+		self._lock = threading.RLock()
+		self._reloadSimulations()
+
+	def _getFileStamp(self):
+		try:
+			st = os.stat(self.fname)
+			return (st.st_mtime_ns, st.st_size)
+		except FileNotFoundError:
+			return None
+
+	# Loads simulations that were saved by other processes since the last load
+	def _reloadSimulations(self):
+		with self._lock:
+			stamp = self._getFileStamp()
+			if stamp is not None and stamp != self._loadedStamp:
+				try:
+					with open(self.fname, 'rb') as f:
+						loaded = pickle.load(f)
+				except:
+					raise Warning('Could not load simulations from {}.'.format(self.fname))
+				# Local modifications that were not saved yet take precedence
+				for kt in self._dirtyKeys:
+					loaded[kt] = self.simulations[kt]
+				self.simulations = loaded
+				self._loadedStamp = stamp
+
+	# Returns the up to date stored value for kt, or None
+	def _getStored(self, kt):
+		with self._lock:
+			self._reloadSimulations()
+			return self.simulations.get(kt)
+
+	def _setStored(self, kt, value):
+		with self._lock:
+			self.simulations[kt] = value
+			self._dirtyKeys.add(kt)
 
+	def _getKeyLockPath(self, kt):
+		os.makedirs(self.lockFolder, exist_ok = True)
+		return os.path.join(self.lockFolder, '{}.lock'.format(getFingerprint(kt)))
+
+	# Merges local modifications with the ones saved by other processes and atomically replaces the file
 	def SaveSimulations(self):
-		# TODO first write to tmp file and then copy
-		with open(self.fname, 'wb') as f:
-			pickle.dump(self.simulations, f)
+		if len(self._dirtyKeys) == 0:
+			return
+		with FileLock(self.fname + '.lock'), self._lock:
+			self._reloadSimulations()
+			# Write to a temporary file first so that readers never see a partially written file
+			fd, tmpName = tempfile.mkstemp(suffix = '.tmp', dir = os.path.dirname(os.path.abspath(self.fname)))
+			with os.fdopen(fd, 'wb') as f:
+				pickle.dump(self.simulations, f)
+			os.replace(tmpName, self.fname)
+			self._loadedStamp = self._getFileStamp()
+			self._dirtyKeys = set()
 
+	# The replicate parameter (if any) is left out of the key so that ensembles of different sizes share the same entry
 	def GetKeyTuple(self, simRunner):
-		return (type(simRunner).__name__,) + simRunner.GetParamKeyTuple()
+		if isinstance(simRunner, ReplicatedSimulationRunner):
+			return simRunner.GetEnsembleMemoKeyTuple()
+		return simRunner.GetMemoKeyTuple()
 
 	def GetSimulationResult(self, simRunner, useMemoization = False):
 		if useMemoization:
 			kt = self.GetKeyTuple(simRunner)
-			updated = False
-			if kt not in self.simulations:
-				print('Running simulation')
-				self.simulations[kt] = simRunner.Simulate()
-				res = self.simulations[kt]
-				updated = True
-			else:
-				res = copy.deepcopy(self.simulations[kt])
-				# Re-owns the simulation
-				res.ReOwn(simRunner)
-			if updated:
+			# Only one process at a time can compute a given key, the others wait and reuse its result
+			with FileLock(self._getKeyLockPath(kt)):
+				stored = self._getStored(kt)
+				if stored is None:
+					print('Running simulation')
+					res = simRunner.Simulate()
+					# Store a copy so that the stored results are never modified by their consumers
+					self._setStored(kt, copy.deepcopy(res))
+				else:
+					res = copy.deepcopy(stored)
+					# Re-owns the simulation
+					res.ReOwn(simRunner)
+					# Top up or truncate the stored replicates to the requested number
+					if isinstance(simRunner, ReplicatedSimulationRunner):
+						nbWanted = getattr(simRunner, simRunner.GetReplicateParam())
+						nbStored = simRunner.GetNbReplicates(res)
+						if nbStored < nbWanted:
+							simRunner.AddReplicates(res, nbWanted - nbStored)
+							self._setStored(kt, copy.deepcopy(res))
+						elif nbStored > nbWanted:
+							simRunner.KeepReplicates(res, nbWanted)
 				self.SaveSimulations()
 			return res
 		else:
 			return simRunner.Simulate()
 
+	# Returns the key identifying the data held by an owned attribute holder, from its owner and its sources
+	def GetDataKeyTuple(self, oah):
+		return (oah.name, oah.owner.GetMemoKeyTuple(), tuple(self.GetDataKeyTuple(s) for s in oah.sources))
+
+	# Analyzer outputs are memoized in the same file as simulations, keyed on the analyzer parameters and on its inputs
+	def GetAnalysisResult(self, analyzer, results, useMemoization = False):
+		if not useMemoization or not analyzer.IsMemoizable():
+			return analyzer.Analyze(results)
+
+		inputs = [oah for name in analyzer.GetInputs() for oah in results.GetOwnedAttr(name)]
+		kt = ('Analysis',) + analyzer.GetMemoKeyTuple() + (tuple(self.GetDataKeyTuple(oah) for oah in inputs),)
+		with FileLock(self._getKeyLockPath(kt)):
+			stored = self._getStored(kt)
+			if stored is None:
+				res = analyzer.Analyze(results)
+				stored = self._getStorableAnalysis(analyzer, res, inputs)
+				if stored is not None:
+					self._setStored(kt, copy.deepcopy(stored))
+					self.SaveSimulations()
+			else:
+				res = Results(analyzer)
+				for name, srcInds, value in copy.deepcopy(stored):
+					res.SetWithSources(name, value, [inputs[i] for i in srcInds])
+		return res
+
+	# Returns the attributes owned by the analyzer as (name, indices of sources in inputs, value) tuples,
+	# or None if some of them come from sources that are not part of the inputs
+	def _getStorableAnalysis(self, analyzer, res, inputs):
+		stored = []
+		for name, lst in res.attributes.items():
+			for oah in lst:
+				if oah.owner == analyzer:
+					srcInds = [i for s in oah.sources for i, inp in enumerate(inputs) if inp is s]
+					if len(srcInds) != len(oah.sources):
+						return None
+					stored.append((name, srcInds, oah.value))
+		return stored
+
 # ABC for SimulationRunner and ResultAnalyzer
 class InputOutput:
 	def GetInputs(self):
@@ -51,10 +174,15 @@ class InputOutput:
 	def GetOutputs(self):
 		return []
 
+	# Returns a key tuple identifying the data that is produced, used for memoization.
+	# Parameters are only represented by their cached fingerprint so that keys are small and built in constant time.
+	def GetMemoKeyTuple(self):
+		return (type(self).__name__, self.GetParamFingerprint())
+
 # Interface for simulation runner classes
 class SimulationRunner(AppParameterizable, Usable, InputOutput, ResultHolder):
-	def __init__(self):
-		AppParameterizable.__init__(self)
+	def __init__(self, params = None):
+		AppParameterizable.__init__(self, params)
 		Usable.__init__(self)
 		InputOutput.__init__(self)
 		ResultHolder.__init__(self)
@@ -64,3 +192,31 @@ class SimulationRunner(AppParameterizable, Usable, InputOutput, ResultHolder):
 	def Simulate(self):
 		pass
 
+# Simulation runner whose results are made of independent replicates.
+# Memoized results of such runners are extended or truncated instead of being recomputed.
+class ReplicatedSimulationRunner(SimulationRunner):
+	# Returns the name of the parameter holding the number of replicates
+	@abstractmethod
+	def GetReplicateParam(self):
+		pass
+
+	# Returns the number of replicates held by a result object returned by Simulate
+	@abstractmethod
+	def GetNbReplicates(self, res):
+		pass
+
+	# Simulates nb new replicates and appends them to res
+	@abstractmethod
+	def AddReplicates(self, res, nb):
+		pass
+
+	# Only keeps the first nb replicates of res
+	@abstractmethod
+	def KeepReplicates(self, res, nb):
+		pass
+
+	# Same as GetMemoKeyTuple without the replicate parameter, so that ensembles of different sizes share the same key
+	def GetEnsembleMemoKeyTuple(self):
+		replParam = self.GetReplicateParam()
+		return (type(self).__name__, self._getCachedFingerprint('ensemble', lambda: tuple(kt for kt in self.GetParamKeyTuple() if kt[0] != replParam)))
+
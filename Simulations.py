@@ -1,5 +1,3 @@
-from multiprocess import Pool
-
 from SimulationManager import *
 from DashUtilities import *
 
@@ -17,9 +15,9 @@ def treeGenSimFunc(v):
 	return (t, rej)
 
 # Generates n trees
-class TreeStatSimulation(SimulationRunner, DashInterfacable):
-	def __init__(self):
-		SimulationRunner.__init__(self)
+class TreeStatSimulation(ReplicatedSimulationRunner, DashInterfacable):
+	def __init__(self, params = None):
+		ReplicatedSimulationRunner.__init__(self, params)
 		DashInterfacable.__init__(self)
 
 	def GetDefaultParams(self):
@@ -35,19 +33,38 @@ class TreeStatSimulation(SimulationRunner, DashInterfacable):
 	def Simulate(self):
 		self.results = Results(self)
 		self.results.trees = []
-		self.results.rejected = 0
-		self.results.total = 0
-		with Pool() as pool:
-			params = [(self.endCondition, self.treeGenerator)]*self.nb_tree
-			for t, rej in pool.imap_unordered(treeGenSimFunc, params):
-				self.results.trees.append(t)
-				self.results.rejected += rej
-				self.results.total += rej + 1
+		self.results.rejections = []
+		self.AddReplicates(self.results, self.nb_tree)
 		return self.results
 
+	def GetReplicateParam(self):
+		return 'nb_tree'
+
+	def GetNbReplicates(self, res):
+		return len(res.trees)
+
+	def AddReplicates(self, res, nb):
+		trees = res.trees
+		rejections = res.rejections
+		with getProcessPool() as pool:
+			params = [(self.endCondition, self.treeGenerator)]*nb
+			for t, rej in pool.imap_unordered(treeGenSimFunc, params):
+				trees.append(t)
+				rejections.append(rej)
+		self._updateRejectionCounts(res)
+
+	def KeepReplicates(self, res, nb):
+		res.trees = res.trees[:nb]
+		res.rejections = res.rejections[:nb]
+		self._updateRejectionCounts(res)
+
+	def _updateRejectionCounts(self, res):
+		res.rejected = sum(res.rejections)
+		res.total = res.rejected + len(res.trees)
+
 	def _getInnerLayout(self):
-		rejected = self.results.GetOwnedAttr('rejected', ind=0, defVal=None, filterFunc=lambda oah: oah.owner == self)
-		total = self.results.GetOwnedAttr('total', ind=0, defVal=None, filterFunc=lambda oah: oah.owner == self)
+		rejected = self.results.GetOwnedAttr('rejected', ind=0, defVal=None, owner=self)
+		total = self.results.GetOwnedAttr('total', ind=0, defVal=None, owner=self)
 		if total is not None and rejected is not None:
 			return html.P('rejected Trees: {}/{}'.format(rejected, total))
 		else:
@@ -58,8 +75,8 @@ import os
 import random
 # Loads a tree from a file
 class TreeLoaderSim(SimulationRunner, DashInterfacable):
-	def __init__(self):
-		SimulationRunner.__init__(self)
+	def __init__(self, params = None):
+		SimulationRunner.__init__(self, params)
 		DashInterfacable.__init__(self)
 
 	def GetDefaultParams(self):
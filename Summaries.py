@@ -0,0 +1,191 @@
+import math
+import numpy as np
+
+# Fixed memory summaries of ensemble statistics, they can be updated value by value
+# and merged, so that partial summaries computed by several workers or batches can be combined
+
+# Histogram with nbBins bins of size binSize starting at 0.
+# A growable histogram doubles its bin size (merging neighbouring bins) instead of dropping values out of its range,
+# so that histograms that started with the same bin size can always be merged.
+class FixedHistogram:
+	def __init__(self, nbBins, binSize, growable = False):
+		if growable and nbBins % 2 != 0:
+			raise ValueError('Growable histograms need an even number of bins.')
+		self.nbBins = nbBins
+		self.binSize = binSize
+		self.growable = growable
+		self.counts = np.zeros(nbBins)
+		# Total weight of the values below 0 and above the range
+		self.underflow = 0
+		self.overflow = 0
+
+	def GetRange(self):
+		return self.nbBins * self.binSize
+
+	def GetEdges(self):
+		return np.arange(self.nbBins + 1) * self.binSize
+
+	def GetCenters(self):
+		return (np.arange(self.nbBins) + 0.5) * self.binSize
+
+	def GetTotal(self):
+		return self.counts.sum() + self.underflow + self.overflow
+
+	# Adds one or several values, with optional weights
+	def Add(self, values, weights = None):
+		values = np.atleast_1d(np.asarray(values, dtype=float))
+		weights = np.ones(len(values)) if weights is None else np.atleast_1d(np.asarray(weights, dtype=float))
+		finite = np.isfinite(values)
+		values, weights = values[finite], weights[finite]
+		if len(values) == 0:
+			return
+		if self.growable:
+			while values.max() >= self.GetRange():
+				self._grow()
+		inds = np.floor(values / self.binSize).astype(int)
+		# As in numpy, the last bin includes its upper edge
+		inds[values == self.GetRange()] = self.nbBins - 1
+		under = inds < 0
+		over = inds >= self.nbBins
+		self.underflow += weights[under].sum()
+		self.overflow += weights[over].sum()
+		inRange = ~(under | over)
+		self.counts += np.bincount(inds[inRange], weights = weights[inRange], minlength = self.nbBins)
+
+	# Adds the content of another histogram
+	def Merge(self, other):
+		if self.nbBins != other.nbBins:
+			raise ValueError('Cannot merge histograms with different numbers of bins.')
+		if other.binSize > self.binSize:
+			if not self.growable:
+				raise ValueError('Cannot merge a histogram with larger bins into a non growable one.')
+			while self.binSize < other.binSize and not math.isclose(self.binSize, other.binSize):
+				self._grow()
+		other = other.CoarsenedTo(self.binSize)
+		self.counts += other.counts
+		self.underflow += other.underflow
+		self.overflow += other.overflow
+
+	# Returns a copy of the histogram with bins of size binSize, that must be the current size times a power of 2
+	def CoarsenedTo(self, binSize):
+		res = FixedHistogram(self.nbBins, self.binSize, growable = True)
+		res.counts = self.counts.copy()
+		res.underflow = self.underflow
+		res.overflow = self.overflow
+		while res.binSize < binSize and not math.isclose(res.binSize, binSize):
+			res._grow()
+		if not math.isclose(res.binSize, binSize):
+			raise ValueError('Bin size {} cannot be obtained by merging bins of size {}.'.format(binSize, self.binSize))
+		res.growable = self.growable
+		return res
+
+	def _grow(self):
+		self.counts = np.concatenate((self.counts.reshape(-1, 2).sum(axis = 1), np.zeros(self.nbBins // 2)))
+		self.binSize *= 2
+
+# Mergeable quantile sketch in the spirit of KLL: values are kept in levels of at most k items,
+# an item at level h standing for 2^h values. Full levels are sorted and one item out of two is promoted.
+class QuantileSketch:
+	def __init__(self, k = 200):
+		self.k = k
+		self.levels = [[]]
+		self.count = 0
+		self.total = 0.0
+		self.min = math.inf
+		self.max = -math.inf
+		# Alternates which half of a compacted level is promoted, to avoid a systematic bias
+		self._offset = 0
+
+	# Adds one or several values, None values are ignored
+	def Add(self, values):
+		if values is None:
+			return
+		for v in ([values] if isinstance(values, (int, float)) else np.atleast_1d(np.asarray(values, dtype=float))):
+			if not math.isnan(v):
+				self.levels[0].append(v)
+				self.count += 1
+				self.total += v
+				self.min = min(self.min, v)
+				self.max = max(self.max, v)
+		# Higher levels only fill up when the first one is compacted
+		if len(self.levels[0]) >= self.k:
+			self._compress()
+
+	# Adds the content of another sketch
+	def Merge(self, other):
+		for h, lvl in enumerate(other.levels):
+			if h >= len(self.levels):
+				self.levels.append([])
+			self.levels[h] += lvl
+		self.count += other.count
+		self.total += other.total
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+		self._compress()
+
+	def _compress(self):
+		h = 0
+		while h < len(self.levels):
+			if len(self.levels[h]) >= self.k:
+				lvl = sorted(self.levels[h])
+				# An odd item out stays at the current level
+				self.levels[h] = [lvl.pop()] if len(lvl) % 2 == 1 else []
+				if h + 1 == len(self.levels):
+					self.levels.append([])
+				self.levels[h + 1] += lvl[self._offset::2]
+				self._offset = 1 - self._offset
+			h += 1
+
+	def GetMean(self):
+		return self.total / self.count if self.count > 0 else None
+
+	# Returns the approximate quantiles of the values for each q in qs, in [0, 1]
+	def GetQuantiles(self, qs):
+		if self.count == 0:
+			return [None for q in qs]
+		items = sorted((v, 2**h) for h, lvl in enumerate(self.levels) for v in lvl)
+		values = np.array([v for v, w in items])
+		cumWeights = np.cumsum([w for v, w in items])
+		res = []
+		for q in qs:
+			if q <= 0:
+				res.append(self.min)
+			elif q >= 1:
+				res.append(self.max)
+			else:
+				res.append(values[min(len(values) - 1, np.searchsorted(cumWeights, q * cumWeights[-1]))])
+		return res
+
+	def GetQuantile(self, q):
+		return self.GetQuantiles([q])[0]
+
+# Distribution over an ensemble of histograms of the content of each bin, as a quantile sketch per bin.
+# Histograms are coarsened to the bin size of the ensemble when they are added.
+class HistogramBands:
+	def __init__(self, nbBins, binSize, k = 200):
+		self.nbBins = nbBins
+		self.binSize = binSize
+		self.sketches = [QuantileSketch(k) for i in range(nbBins)]
+
+	def GetCenters(self):
+		return (np.arange(self.nbBins) + 0.5) * self.binSize
+
+	# Adds the content of one histogram, divided by norm
+	def Add(self, hist, norm = 1.0):
+		if not math.isclose(hist.binSize, self.binSize):
+			hist = hist.CoarsenedTo(self.binSize)
+		for sketch, v in zip(self.sketches, hist.counts / norm):
+			sketch.Add(v)
+
+	def Merge(self, other):
+		if self.nbBins != other.nbBins or not math.isclose(self.binSize, other.binSize):
+			raise ValueError('Cannot merge histogram bands with different binnings.')
+		for sketch, otherSketch in zip(self.sketches, other.sketches):
+			sketch.Merge(otherSketch)
+
+	def GetMeans(self):
+		return [sketch.GetMean() for sketch in self.sketches]
+
+	# Returns the q-quantile of each bin
+	def GetQuantiles(self, q):
+		return [sketch.GetQuantile(q) for sketch in self.sketches]
@@ -5,53 +5,162 @@ import copy
 import random
 from scipy.stats import spearmanr, levene
 import math
+from multiprocess import cpu_count, current_process
 
 from TreeGenerators import *
 from WComputations import *
+from ROCComputations import *
+from Simulations import *
+
+# Per tree function of the surrogate testing runners: generates a tree, samples clades among the nodes whose rank
+# in age order is between cladeThrMin and cladeThrMax, and returns for each of them the original W2, one surrogate W2
+# and the p-value of the original W2 among nbReplicates surrogate values.
+def surrogateTreeFunc(v):
+	treeGenerator, endCondition, nbClades, cladeThrMin, cladeThrMax, surrogateStrat, nbReplicates = v
+	t, rej = treeGenSimFunc((endCondition, treeGenerator))
+	allNodes = [n for i,n in enumerate(t.ageorder_node_iter(include_leaves = True, descending = True)) if cladeThrMin <= i <= cladeThrMax]
+	clades = random.sample(allNodes, nbClades)
+	res = []
+	for c, w2 in zip(clades, computeW2Batch(t, clades).tolist()):
+		surrW2 = surrogateStrat.generateMany(t, c, nbReplicates)
+		res.append((w2, surrW2[0], getSurrogatePValue(w2, surrW2)))
+	return res
+
+# Utility function for runSurrogateArms
+def surrogateArmTreeFunc(v):
+	armName, treeParams = v
+	return armName, surrogateTreeFunc(treeParams)
+
+# Names of the statistics returned by getSurrogateStats
+surrogateStatNames = ['correl', 'correlPval', 'origW2Mean', 'origW2Std', 'surrW2Mean', 'surrW2Std', 'LevenePVal']
+
+# Statistics comparing the original and surrogate W2 values of an arm. All of them are always given,
+# the ones that cannot be computed yet are NaN (means without values, tests with less than 3 values).
+def getSurrogateStats(arm):
+	stats = {name:np.nan for name in surrogateStatNames}
+	if len(arm.origW2) > 0:
+		stats['origW2Mean'] = np.mean(arm.origW2)
+		stats['origW2Std'] = np.std(arm.origW2)
+		stats['surrW2Mean'] = np.mean(arm.surrW2)
+		stats['surrW2Std'] = np.std(arm.surrW2)
+	if len(arm.origW2) >= 3:
+		stats['correl'], stats['correlPval'] = spearmanr(arm.origW2, arm.surrW2)
+		leveneVal, stats['LevenePVal'] = levene(arm.origW2, arm.surrW2)
+	return stats
+
+# Relative increase of the number of trees of an arm between two updates of its partial statistics
+partialStatsGrowth = 1.1
+
+# Runs surrogate testing arms, given as arm name -> parameters of surrogateTreeFunc, for nbTrees trees each on a
+# shared process pool. Trees of all arms are interleaved so that the arms progress concurrently. The statistics of
+# an arm are updated as its trees are done, and given to onPartialStats(armName, stats).
+# Returns arm name -> arm, holding the lists origW2, surrW2 and pVals and the final stats.
+def runSurrogateArms(arms, nbTrees, onPartialStats = lambda armName, stats: None):
+	res = {}
+	for armName in arms:
+		res[armName] = TmpObject()
+		res[armName].origW2 = []
+		res[armName].surrW2 = []
+		res[armName].pVals = []
+		res[armName].stats = getSurrogateStats(res[armName])
+	nbDone = {armName:0 for armName in arms}
+	nextUpdate = {armName:1 for armName in arms}
+	tasks = [(armName, treeParams) for i in range(nbTrees) for armName, treeParams in arms.items()]
+	with getProcessPool() as pool:
+		for armName, perClade in pool.imap_unordered(surrogateArmTreeFunc, tasks):
+			arm = res[armName]
+			for w2, surrW2, pVal in perClade:
+				arm.origW2.append(w2)
+				arm.surrW2.append(surrW2)
+				arm.pVals.append(pVal)
+			nbDone[armName] += 1
+			if nbDone[armName] >= nextUpdate[armName] or nbDone[armName] == nbTrees:
+				nextUpdate[armName] = nbDone[armName] * partialStatsGrowth
+				arm.stats = getSurrogateStats(arm)
+				onPartialStats(armName, arm.stats)
+	return res
 
 class W2SurrogateTestingSimRunner(SimulationRunner):
+	def __init__(self, params = None):
+		SimulationRunner.__init__(self, params)
+		# Arm name -> latest statistics, updated while Simulate runs
+		self.partialStats = {}
+
 	def GetDefaultParams(self):
 		return ParametersDescr({
 			'nb_tree' : (10, int),
-			'tree_size' : (20, int),
+			'endCondition' : (NumExtantStopCrit(), StoppingCriteria),
 			'nb_clades' : (1, int),
+			'nb_replicates' : (100, int),
 			'cladeThrMin' : (5, int),
 			'cladeThrMax' : (9, int),
-			'surrogateStrat' : (BernoulliSurrogateStrat(), SurrogateStrat),
+			'surrogateStrat' : (BernoulliSurrogateStrat(), SurogateStrat),
 			'treeGenerator' : (NeutralTreeGenerator(), TreeGenerator)
 		})
 
+	def GetOutputs(self):
+		return ['origW2', 'surrW2', 'pVals', 'stats']
+
+	def _getTreeParams(self, treeGenerator, surrogateStrat):
+		return (treeGenerator, self.endCondition, self.nb_clades, self.cladeThrMin, self.cladeThrMax, surrogateStrat, self.nb_replicates)
+
+	def _runArms(self, arms):
+		self.partialStats = {}
+		return runSurrogateArms(arms, self.nb_tree, self.OnPartialStats)
+
+	# Called each time the statistics of an arm are updated, overload this to follow a running simulation
+	def OnPartialStats(self, armName, stats):
+		self.partialStats[armName] = stats
+
 	def Simulate(self):
-		res = Results()
-		res.origW2 = []
-		res.surrW2 = []
-		res.stats = {}
-
-		for i in range(self.nb_tree):
-			# Generate tree
-			t = self.treeGenerator.generate(self.tree_size)
-
-			# Sample a clade
-			allNodes = [n for i,n in enumerate(t.ageorder_node_iter(include_leaves = True, descending = True)) if self.cladeThrMin <= i <= self.cladeThrMax]
-			for c in random.sample(allNodes, self.nb_clades):
-				res.origW2.append(computeW2(t, c))
-				res.surrW2.append(self.surrogateStrat.generate(t, c))
-
-		# Compute stats
-		res.stats['correl'], res.stats['correlPval'] = spearmanr(res.origW2, res.surrW2)
-		res.stats['origW2Mean'] = np.mean(res.origW2)
-		res.stats['origW2Std'] = np.std(res.origW2)
-		res.stats['surrW2Mean'] = np.mean(res.surrW2)
-		res.stats['surrW2Std'] = np.std(res.surrW2)
-		leveneVal, res.stats['LevenePVal'] = levene(res.origW2, res.surrW2)
+		arm = self._runArms({'': self._getTreeParams(self.treeGenerator, self.surrogateStrat)})['']
+		res = Results(self)
+		res.origW2 = arm.origW2
+		res.surrW2 = arm.surrW2
+		res.pVals = arm.pVals
+		res.stats = arm.stats
+
+		self.results = res
+		return res
 
+# Runs the Bernoulli and simulated surrogates on neutral and non neutral trees, the four arms sharing one process pool
+class W2SurrogateROCSimRunner(W2SurrogateTestingSimRunner):
+	def GetDefaultParams(self):
+		return ParametersDescr({
+			'nb_tree' : (10, int),
+			'endCondition' : (NumExtantStopCrit(), StoppingCriteria),
+			'nb_clades' : (1, int),
+			'nb_replicates' : (100, int),
+			'cladeThrMin' : (5, int),
+			'cladeThrMax' : (9, int),
+			'neutralTreeGenerator' : (NeutralTreeGenerator(), TreeGenerator),
+			'treeGenerator' : (NeutralTreeGenerator(), TreeGenerator)
+		})
+
+	def GetOutputs(self):
+		return ['bernneutral', 'bernnonNeutral', 'simneutral', 'simnonNeutral']
+
+	def Simulate(self):
+		arms = {}
+		for stratName, strat in [('bern', BernoulliSurrogateStrat()), ('sim', SimulatedNeutralSurrogate())]:
+			arms[stratName + 'neutral'] = self._getTreeParams(self.neutralTreeGenerator, strat)
+			arms[stratName + 'nonNeutral'] = self._getTreeParams(self.treeGenerator, strat)
+		allArms = self._runArms(arms)
+		res = Results(self)
+		for armName, arm in allArms.items():
+			setattr(res, armName, arm)
+
+		self.results = res
 		return res
 
 class W2SurrogateTestingPlotter(ResultPlotter):
 	def Plot(self):
 		fig, ax = plt.subplots(2,2, figsize=(14,10))
-		allMin = min(min(self.surrW2), min(self.origW2))
-		allMax = max(max(self.surrW2), max(self.origW2))
+		# Axes still have a range when there is no W2 value yet, or a single distinct one
+		allMin = min(list(self.surrW2) + list(self.origW2), default = 0.0)
+		allMax = max(list(self.surrW2) + list(self.origW2), default = 1.0)
+		if allMax == allMin:
+			allMin, allMax = allMin - 0.5, allMax + 0.5
 		lineH = len(self.surrW2) / 20
 
 		ax[0][0].hist(self.surrW2, orientation='horizontal', range=(allMin, allMax), bins=20)
@@ -79,41 +188,30 @@ class W2SurrogateTestingPlotter(ResultPlotter):
 		return ax
 
 class W2SurrogateTestingROCPlotter(ResultPlotter):
+	# Fraction of neutral (true positives) and non neutral (false positives) original W2 values inside the central
+	# intervals of their surrogate W2 values, for all interval levels, and bootstrap bands of the curve
 	def getROCVals(self, ns, no, nns, nno):
-		truePos = []
-		falsePos = []
-		for pval in np.arange(0, 1.01, 0.01):
-			minv, maxv = ns[int(pval/2*len(ns))], ns[-int(pval/2*len(ns))-1]
-			filtNo = list(filter(lambda x: minv <= x <= maxv, no))
-			truePos.append(len(filtNo) / len(no))
-
-			minv, maxv = nns[int(pval/2*len(nns))], nns[-int(pval/2*len(nns))-1]
-			filtNno = list(filter(lambda x: minv <= x <= maxv, nno))
-			falsePos.append(len(filtNno) / len(no))
-		return truePos, falsePos
+		nPVals = getTwoSidedPValues(ns, no)
+		nnPVals = getTwoSidedPValues(nns, nno)
+		falsePos, truePos = computeROC(nPVals, nnPVals)
+		return truePos, falsePos, bootstrapROC(nPVals, nnPVals)
 
 	def Plot(self):
 		fig, ax = plt.subplots()
 
-		ns = sorted(self.bernneutral.surrW2)
-		no = self.bernneutral.origW2
-		nns = sorted(self.bernnonNeutral.surrW2)
-		nno = self.bernnonNeutral.origW2
-		truePos, falsePos = self.getROCVals(ns, no, nns, nno)
-
-		ax.plot(falsePos, truePos, 'r')
+		for name, color, neutral, nonNeutral in [('Bernoulli surrogate', 'r', self.bernneutral, self.bernnonNeutral), ('Simulated surrogate', 'g', self.simneutral, self.simnonNeutral)]:
+			ns = sorted(neutral.surrW2)
+			no = neutral.origW2
+			nns = sorted(nonNeutral.surrW2)
+			nno = nonNeutral.origW2
+			truePos, falsePos, bands = self.getROCVals(ns, no, nns, nno)
 
-		ns = sorted(self.simneutral.surrW2)
-		no = self.simneutral.origW2
-		nns = sorted(self.simnonNeutral.surrW2)
-		nno = self.simnonNeutral.origW2
-		truePos, falsePos = self.getROCVals(ns, no, nns, nno)
-
-		ax.plot(falsePos, truePos, 'g')
+			ax.fill_between(bands.falsePos, bands.low, bands.high, color=color, alpha=0.2)
+			ax.plot(falsePos, truePos, color, label='{} (AUC: {:.3f})'.format(name, computeAUC(falsePos, truePos)))
 
 		ax.plot([0, 1], [0, 1], '-k')
 
-		ax.legend(['Bernoulli surrogate', 'Simulated surrogate'])
+		ax.legend()
 		ax.set_ylabel('True positives')
 		ax.set_xlabel('False positives')
 
@@ -124,52 +222,101 @@ class SurogateStrat(Parameterizable):
 	def generate(self, tree, clade):
 		pass
 
+	# Returns nbReplicates surrogate W2 values, overload this if they can be drawn at once
+	def generateMany(self, tree, clade, nbReplicates):
+		return np.array([self.generate(tree, clade) for i in range(nbReplicates)])
+
 class BernoulliSurrogateStrat(SurogateStrat):
 	def generate(self, tree, clade):
-		W2_num = 0
-		W2_den = 0
-		for n in tree.ageorder_node_iter(include_leaves = True, descending = True, filter_fn = lambda x: x.age < clade.age):
-			W2_num += 1 - n.p_i if random.random() < n.p_i else -n.p_i
-			W2_den += n.p_i*(1.0-n.p_i)
-		return W2_num / math.sqrt(W2_den) if W2_den > 0 else 0
-
-
+		return self.generateMany(tree, clade, 1)[0]
+
+	# Uses the p_i of the nodes younger than the clade, stored by computeW2 or computeW2Batch
+	def generateMany(self, tree, clade, nbReplicates):
+		return drawBernoulliW2(clade.W2_pi, nbReplicates)
+
+
+# Snapshot of tree t cut at the age of a clade, as arrays in preorder: the nodes older than the cut and the lineages
+# crossing it, that become tips at the cut. Ages are counted from the cut, the tree is not modified.
+def getCutTreeArrays(t, clade):
+	index = getTreeIndex(t)
+	parents = index.parents
+	ages = index.ages
+	isLeaf = index.isLeaf
+	t_i = ages[index.GetInd(clade)]
+	parentAges = np.where(parents >= 0, ages[parents], math.inf)
+	# Parents of kept nodes are kept, so kept nodes stay in preorder
+	kept = (ages >= t_i) | (parentAges > t_i)
+	newInds = np.cumsum(kept) - 1
+
+	cut = TmpObject()
+	cut.parents = np.where(parents[kept] >= 0, newInds[parents[kept]], -1)
+	cut.ages = np.maximum(ages[kept], t_i) - t_i
+	cut.isTip = np.ones(len(cut.parents), dtype=bool)
+	cut.isTip[cut.parents[cut.parents >= 0]] = False
+	# Tips older than the cut are extinct lineages, they are not regrown
+	cut.isAlive = cut.isTip & ~(isLeaf[kept] & (ages[kept] > t_i))
+	cut.cladeInd = newInds[index.GetInd(clade)]
+	cut.nbLeaves = np.count_nonzero(isLeaf)
+	return cut
+
+# Neutrally regrows a cut tree until it has as many leaves as the original tree: at each step an alive tip,
+# chosen uniformly, is split in two and all alive tips then grow by deltaT.
+# Returns the parents, leaf flags and ages of the grown tree in preorder and the index of the clade.
+def regrowCutTree(cut, rng, deltaT = 1):
+	nbKept = len(cut.parents)
+	tips = np.flatnonzero(cut.isAlive).tolist()
+	nbSteps = max(0, cut.nbLeaves - np.count_nonzero(cut.isTip)) if len(tips) > 0 else 0
+	choices = (rng.random(nbSteps) * (len(tips) + np.arange(nbSteps))).astype(int).tolist()
+
+	parents = np.concatenate((cut.parents, np.zeros(2 * nbSteps, dtype=int)))
+	# Step at which each node was split, tips that are never split end up at the present
+	splitSteps = np.full(nbKept + 2 * nbSteps, nbSteps)
+	for s, j in enumerate(choices):
+		tip = tips[j]
+		splitSteps[tip] = s
+		parents[nbKept + 2*s] = tip
+		parents[nbKept + 2*s + 1] = tip
+		tips[j] = nbKept + 2*s
+		tips.append(nbKept + 2*s + 1)
+
+	isLeaf = np.concatenate((cut.isTip, np.ones(2 * nbSteps, dtype=bool)))
+	isLeaf[splitSteps < nbSteps] = False
+	ages = (nbSteps - splitSteps) * float(deltaT)
+	notAlive = np.flatnonzero(~cut.isAlive)
+	ages[notAlive] = cut.ages[notAlive] + nbSteps * deltaT
+
+	order = getPreorderFromParents(parents)
+	newInds = np.empty(len(order), dtype=int)
+	newInds[order] = np.arange(len(order))
+	newParents = np.where(parents[order] >= 0, newInds[parents[order]], -1)
+	return newParents, isLeaf[order], ages[order], newInds[cut.cladeInd]
+
+# Returns nbReplicates W2 values of the clade of a cut tree, each one after an independent neutral regrowth
+def simulatedNeutralW2(cut, nbReplicates, seed = None):
+	rng = np.random.default_rng(seed)
+	res = np.zeros(nbReplicates)
+	for r in range(nbReplicates):
+		parents, isLeaf, ages, cladeInd = regrowCutTree(cut, rng)
+		for num, den, allPi in iterW2BatchFromArrays(parents, isLeaf, ages, [cladeInd], withPi = False):
+			res[r] = num / math.sqrt(den) if den > 0 else 0
+	return res
+
+# Number of replicates above which SimulatedNeutralSurrogate regrows trees on a process pool
+surrogateParallelThreshold = 100
+
+# Cuts the tree at the age of the clade and regrows it neutrally until it reaches the same number of leaves.
+# The tree is cut once into arrays for all replicates and is not modified.
 class SimulatedNeutralSurrogate(SurogateStrat):
 	def generate(self, t, clade):
-		# Cut tree t at time t_i
-		nb_tips = len(t.leaf_nodes())
-		nodes = list(t.ageorder_node_iter(include_leaves=True, descending=False))
-		t_i = clade.age
-		for n in nodes:
-			if n.age >= t_i:
-				break
-			else:
-				p = n.parent_node 
-				if p.age > t_i:	# Adjust edge
-					n.edge_length = n.parent_node.age - t_i
-				else: # Remove node
-					p.remove_child(n, suppress_unifurcations=False)
-
-		# Neutrally evolve tree from time t_i until it reaches n leaves again
-		delta_t = 1#sum(n.edge.length for n in t.leaf_nodes())/len(t.leaf_nodes())
-
-		while len(t.leaf_nodes()) < nb_tips:
-			evolved_tip = random.choice(t.leaf_nodes())
-			evolved_tip.taxon = ""
-
-			# Branch node
-			ch1 = evolved_tip.new_child()
-			ch2 = evolved_tip.new_child()
-
-			ch1.edge.length = 0.0
-			ch2.edge.length = 0.0
-
-			# Update time for all tips
-			for tip in t.leaf_nodes():
-				tip.edge.length += delta_t
-
-		t.randomly_assign_taxa()
-
-		t.calc_node_ages()
-		return computeW2(t, clade)
-
+		return self.generateMany(t, clade, 1)[0]
+
+	def generateMany(self, t, clade, nbReplicates):
+		cut = getCutTreeArrays(t, clade)
+		# Workers of a pool cannot have their own pool, their replicates are regrown serially
+		if nbReplicates < surrogateParallelThreshold or current_process().daemon:
+			return simulatedNeutralW2(cut, nbReplicates)
+		nbChunks = min(nbReplicates, 4 * cpu_count())
+		chunkSizes = np.diff(np.linspace(0, nbReplicates, nbChunks + 1).astype(int)).tolist()
+		seeds = np.random.SeedSequence().spawn(nbChunks)
+		with getProcessPool() as pool:
+			return np.concatenate(pool.starmap(simulatedNeutralW2, [(cut, size, seed) for size, seed in zip(chunkSizes, seeds)]))
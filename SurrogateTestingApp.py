@@ -13,9 +13,9 @@ class SurrogateTestingApp(server.App):
 				type = 'dropdown',
 				label = 'Tree generator',
 				options = [
-					{"label": "Neutral Tree", "value":"NeutralTreeGenerator(Parameters(birth_rate=1, death_rate=0))", "checked":True},
-					{"label":"Explosive Radiation", "value":"NonNeutralTreeGenerator(Parameters(rf = ExplosiveRadiationRateFunc(Parameters(timeDelay=0.1, basalRate=2, lowRate=0.05))))"},
-					{"label":"Trait Evolution Linear Brownian", "value":"NonNeutralTreeGenerator(Parameters(rf=TraitEvolLinearBrownian(Parameters(basalRate=1, sigma=0.8, lowestRate=0.01))))"}
+					{"label": "Neutral Tree", "value":"NeutralTreeGenerator(Parameters(birth_rate=1.0, death_rate=0.0))", "checked":True},
+					{"label":"Explosive Radiation", "value":"RateFunctionTreeGenerator(Parameters(birth_rf = ExplosiveRadiationRateFunc(Parameters(timeDelay=0.1, basalRate=2, lowRate=0.05)), death_rf = ConstantRateFunction(Parameters(rate=0.0))))"},
+					{"label":"Trait Evolution Linear Brownian", "value":"RateFunctionTreeGenerator(Parameters(birth_rf = TraitEvolLinearBrownian(Parameters(basalRate=1, sigma=0.8, lowestRate=0.01)), death_rf = ConstantRateFunction(Parameters(rate=0.0))))"}
 				],
 				key = 'treeGenerator'),
 			dict(
@@ -40,6 +40,11 @@ class SurrogateTestingApp(server.App):
 				key='nbClades',
 				label='Number of clades',
 				value='1'),
+			dict(
+				type='text',
+				key='nbReplicates',
+				label='Number of surrogate replicates',
+				value='100'),
 			dict(
 				type='text',
 				key='cladeThrMin',
@@ -72,8 +77,9 @@ class SurrogateTestingApp(server.App):
 	def GetParams(self, params):
 		params = Parameters(
 			nb_tree = int(params['nbTrees']),
-			tree_size = int(params['treeSize']),
+			endCondition = NumExtantStopCrit(Parameters(num_extant_tips = int(params['treeSize']))),
 			nb_clades = int(params['nbClades']),
+			nb_replicates = int(params['nbReplicates']),
 			cladeThrMin = float(params['cladeThrMin']),
 			cladeThrMax = float(params['cladeThrMax']),
 			surrogateStrat = eval(params['surrogateStrat']),
@@ -91,32 +97,12 @@ class SurrogateTestingApp(server.App):
 		return ax[0][1]
 
 	def ROCPlot(self, params):
-		nonNeutTreeGen = eval(params['treeGenerator'])
-
 		params = self.GetParams(params)
 
-		neutTreeGen = NeutralTreeGenerator(Parameters(birth_rate=1, death_rate=0))
-		#nonNeutTreeGen = NonNeutralTreeGenerator(Parameters(rf=TraitEvolLinearBrownian(Parameters(basalRate=1, sigma=0.8, lowestRate=0.01))))
-		bernSurrStrat = BernoulliSurrogateStrat()
-		simSurrStrat = SimulatedNeutralSurrogate()
-
-		allRes = Results()
-		params.SetParam('surrogateStrat', bernSurrStrat)
-		params.SetParam('treeGenerator', neutTreeGen)
-		allRes.bernneutral = SimManager.GetSimulationResult(W2SurrogateTestingSimRunner(params))
-		SimManager.SaveSimulations()
-
-		params.SetParam('treeGenerator', nonNeutTreeGen)
-		allRes.bernnonNeutral = SimManager.GetSimulationResult(W2SurrogateTestingSimRunner(params))
-		SimManager.SaveSimulations()
-
-		params.SetParam('surrogateStrat', simSurrStrat)
-		params.SetParam('treeGenerator', neutTreeGen)
-		allRes.simneutral = SimManager.GetSimulationResult(W2SurrogateTestingSimRunner(params))
-		SimManager.SaveSimulations()
+		params.SetParam('neutralTreeGenerator', NeutralTreeGenerator(Parameters(birth_rate=1.0, death_rate=0.0)))
 
-		params.SetParam('treeGenerator', nonNeutTreeGen)
-		allRes.simnonNeutral = SimManager.GetSimulationResult(W2SurrogateTestingSimRunner(params))
+		# The four arms (Bernoulli and simulated surrogates on neutral and non neutral trees) run concurrently
+		allRes = SimManager.GetSimulationResult(W2SurrogateROCSimRunner(params))
 		SimManager.SaveSimulations()
 
 		rp = W2SurrogateTestingROCPlotter(allRes)
@@ -125,4 +111,6 @@ class SurrogateTestingApp(server.App):
 		
 
 app = SurrogateTestingApp()
-app.launch()
+# Process pool workers import this module without launching the app
+if __name__ == '__main__':
+	app.launch()
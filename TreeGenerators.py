@@ -6,45 +6,21 @@ from dendropy.simulate import treesim
 import numpy as np
 from Utilities import *
 from DashUtilities import *
+from TreeIndex import *
 
 class TreeGenerator(Parameterizable, DashInterfacable):
-	def __init__(self):
-		Parameterizable.__init__(self)
+	def __init__(self, params = None):
+		Parameterizable.__init__(self, params)
 		DashInterfacable.__init__(self)
 
 	@abstractmethod
 	def generate(self, stopCriteria):
 		pass
 
-#class NeutralTreeGenerator(TreeGenerator):
-#	def GetDefaultParams(self):
-#		return ParametersDescr({
-#			'birth_rate' : (1.0,),
-#			'death_rate' : (0.0,)
-#		})
-#
-#	def generate(self, num_extant_tips = None, max_time = None):
-#		if num_extant_tips is not None:
-#			t = treesim.birth_death_tree(birth_rate=self.birth_rate, death_rate=self.death_rate, num_extant_tips=num_extant_tips, is_retain_extinct_tips = True)
-#		elif max_time is not None:
-#			t = treesim.birth_death_tree(birth_rate=self.birth_rate, death_rate=self.death_rate, max_time=max_time, is_retain_extinct_tips = True)
-#		else:
-#			raise ValueError('At least one ending condition must be specified.')
-#
-#		# TODO Fix max_time here
-#
-#		# TODO What to do about this?
-#		# Get last nodes generated (a cherry with branch lenghts = 0) and replace a cherry by one single node
-#		#lastleaf=[n for n in t.leaf_nodes() if n.edge_length == 0][0]
-#		#parent=lastleaf.parent_node
-#		#parent.remove_child(lastleaf, suppress_unifurcations=True)
-#		return t
-
-
 # Utility class for tree generators
 class StoppingCriteria(Parameterizable, DashInterfacable):
-	def __init__(self):
-		Parameterizable.__init__(self)
+	def __init__(self, params = None):
+		Parameterizable.__init__(self, params)
 		DashInterfacable.__init__(self)
 
 	@abstractmethod
@@ -79,7 +55,7 @@ class MaxTimeStopCrit(StoppingCriteria):
 		return total_time >= self.max_time or len(extant_tips) == 0
 	
 	def isFinished(self, tree):
-		return max(tree.calc_node_root_distances(return_leaf_distances_only=True)) + tree.seed_node.edge.length >= self.max_time
+		return getTreeIndex(tree).GetHeight() >= self.max_time
 
 	def correctTree(self, tree, c1, c2, total_time, isBirth, **kwargs):
 		if total_time > self.max_time:
@@ -90,6 +66,7 @@ class MaxTimeStopCrit(StoppingCriteria):
 			for n in tree.leaf_nodes():
 				if not hasattr(n, 'is_extinct') or not n.is_extinct:
 					n.edge.length -= total_time - self.max_time
+			invalidateTreeIndex(tree)
 
 class NumLeavesStopCrit(StoppingCriteria):
 	def GetDefaultParams(self):
@@ -108,8 +85,8 @@ class NumLeavesStopCrit(StoppingCriteria):
 ##########################
 
 class RateFunctionTreeGenerator(TreeGenerator):
-	def __init__(self):
-		TreeGenerator.__init__(self)
+	def __init__(self, params = None):
+		TreeGenerator.__init__(self, params)
 
 
 	def GetDefaultParams(self):
@@ -211,13 +188,82 @@ class RateFunctionTreeGenerator(TreeGenerator):
 			
 		return tree
 
+# Number of events whose random values are drawn at once by NeutralTreeGenerator
+neutralEventChunkSize = 1024
+
+# Constant rate birth-death trees, equivalent to RateFunctionTreeGenerator with constant rate functions.
+# Since rates do not depend on the tips, the waiting time and the kind of each event only depend on the number of
+# extant tips: events are simulated on node arrays with random values drawn in chunks, and the dendropy tree is
+# only built once the stopping criterion is met.
+class NeutralTreeGenerator(TreeGenerator):
+	def GetDefaultParams(self):
+		return ParametersDescr({
+			'birth_rate' : (1.0, float),
+			'death_rate' : (0.0, float)
+		})
+
+	def generate(self, stopCriteria):
+		# A fresh generator, numpy's global state being copied in forked pool workers
+		rng = np.random.default_rng()
+		totRate = self.birth_rate + self.death_rate
+		if self.birth_rate < 0 or self.death_rate < 0 or totRate <= 0:
+			raise ValueError('Birth and death rates must be non negative with a positive sum, got {} and {}.'.format(self.birth_rate, self.death_rate))
+		birthProb = self.birth_rate / totRate
+		parents = [-1]
+		# Time at which the edge of each node starts and ends (None while the node is an extant tip)
+		startTimes = [0.0]
+		endTimes = [None]
+		extant_tips = [0]
+		extinct_tips = []
+		total_time = 0
+		isBirth = False
+		events = []
+		while not stopCriteria.shouldStop(extant_tips=extant_tips, extinct_tips=extinct_tips, total_time=total_time):
+			if len(events) == 0:
+				events = rng.random((neutralEventChunkSize, 3)).tolist()
+			uTime, uKind, uTip = events.pop()
+			total_time += -math.log(1.0 - uTime) / (len(extant_tips) * totRate)
+			tipInd = min(int(uTip * len(extant_tips)), len(extant_tips) - 1)
+			nd = extant_tips[tipInd]
+			endTimes[nd] = total_time
+			# Swap removal, extant tips are always chosen uniformly
+			extant_tips[tipInd] = extant_tips[-1]
+			extant_tips.pop()
+			isBirth = uKind < birthProb
+			if isBirth:
+				for c in range(2):
+					extant_tips.append(len(parents))
+					parents.append(nd)
+					startTimes.append(total_time)
+					endTimes.append(None)
+			else:
+				extinct_tips.append(nd)
+
+		taxon_namespace = dendropy.TaxonNamespace()
+		tree = dendropy.Tree(taxon_namespace=taxon_namespace)
+		tree.is_rooted = True
+		nodes = [tree.seed_node]
+		for i in range(1, len(parents)):
+			nodes.append(nodes[parents[i]].new_child())
+		for nd, st, et in zip(nodes, startTimes, endTimes):
+			nd.edge.length = (total_time if et is None else et) - st
+		for i in extinct_tips:
+			setattr(nodes[i], 'is_extinct', True)
+
+		# Correct the tree if the stopping criterion was not exactly respected (over time, etc)
+		c1, c2 = (nodes[-2], nodes[-1]) if isBirth else (None, None)
+		stopCriteria.correctTree(tree=tree, c1=c1, c2=c2, total_time=total_time, isBirth=isBirth,
+			extant_tips=[nodes[i] for i in extant_tips], extinct_tips=set(nodes[i] for i in extinct_tips))
+
+		return tree
+
 ##################
 # Rate Functions #
 ##################
 
 class NonNeutralRateFunction(Parameterizable, DashInterfacable):
-	def __init__(self):
-		Parameterizable.__init__(self)
+	def __init__(self, params = None):
+		Parameterizable.__init__(self, params)
 		DashInterfacable.__init__(self)
 
 	@abstractmethod
@@ -272,8 +318,8 @@ class ExplosiveRadiationRateFunc(NonNeutralRateFunction):
 		return self.basalRate
 
 class TraitEvolLinearBrownian(NonNeutralRateFunction):
-	def __init__(self):
-		NonNeutralRateFunction.__init__(self)
+	def __init__(self, params = None):
+		NonNeutralRateFunction.__init__(self, params)
 		self.traitValname = 'traitVal' + str(id(self))
 
 	def GetDefaultParams(self):
@@ -300,8 +346,8 @@ class TraitEvolLinearBrownian(NonNeutralRateFunction):
 		return self.basalRate
 
 class ExtendedExplRadRateFunc(NonNeutralRateFunction):
-	def __init__(self):
-		NonNeutralRateFunction.__init__(self)
+	def __init__(self, params = None):
+		NonNeutralRateFunction.__init__(self, params)
 		self.stepTimes = []
 
 	def GetDefaultParams(self):
@@ -331,8 +377,8 @@ class ExtendedExplRadRateFunc(NonNeutralRateFunction):
 		self.stepTimes = [self.endDelay * ((i+1) / self.nbSteps) for i in range(self.nbSteps)]
 		
 class PhaseRateFunc(NonNeutralRateFunction):
-	def __init__(self):
-		NonNeutralRateFunction.__init__(self)
+	def __init__(self, params = None):
+		NonNeutralRateFunction.__init__(self, params)
 		self.stepVals = []
 		self.actualFunc = lambda x:x
 	
@@ -360,8 +406,8 @@ class PhaseRateFunc(NonNeutralRateFunction):
 		return self.maxRate
 	
 class ExtantSizeRateFunc(NonNeutralRateFunction):
-	def __init__(self):
-		NonNeutralRateFunction.__init__(self)
+	def __init__(self, params = None):
+		NonNeutralRateFunction.__init__(self, params)
 		self.actualFunc = lambda x:x
 		self.lastNbExtant = 1
 
@@ -388,8 +434,8 @@ class ExtantSizeRateFunc(NonNeutralRateFunction):
 		return True
 
 class ImmunizationRateFunc(NonNeutralRateFunction):
-	def __init__(self):
-		NonNeutralRateFunction.__init__(self)
+	def __init__(self, params = None):
+		NonNeutralRateFunction.__init__(self, params)
 		self.traitValname = 'traitVal' + str(id(self))
 		self.immunization = {}
 		self.lastTime = 0
@@ -446,8 +492,8 @@ class ImmunizationRateFunc(NonNeutralRateFunction):
 
 class SortRateFunc(NonNeutralRateFunction):
 
-	def __init__(self):
-		NonNeutralRateFunction.__init__(self)
+	def __init__(self, params = None):
+		NonNeutralRateFunction.__init__(self, params)
 		self.actualFunc = lambda x:x
 	
 	def GetDefaultParams(self):
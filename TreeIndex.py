@@ -0,0 +1,110 @@
+import weakref
+import numpy as np
+
+##############
+# Tree index #
+##############
+
+# Arrays describing the nodes of a tree in preorder, built in a single traversal and shared by all the computations
+# done on the tree instead of node attributes (age, root_distance, ...) recomputed by each of them.
+# The clade of node i is the preorder interval [i, cladeEnds[i]), the entry and exit times of an Euler tour.
+class TreeIndex:
+	def __init__(self, t):
+		self.nodes = list(t.preorder_node_iter())
+		self.indices = {nd:i for i, nd in enumerate(self.nodes)}
+		nbNodes = len(self.nodes)
+		parents = [self.indices[nd.parent_node] if nd.parent_node is not None else -1 for nd in self.nodes]
+		edgeLengths = [nd.edge.length if nd.edge.length is not None else 0.0 for nd in self.nodes]
+		self.parents = np.array(parents, dtype=int)
+		self.edgeLengths = np.array(edgeLengths, dtype=float)
+		self.isLeaf = np.array([nd.is_leaf() for nd in self.nodes], dtype=bool)
+		# Time elapsed between the start of the tree and its root
+		self.rootTime = edgeLengths[0] if nbNodes > 0 else 0.0
+
+		# Parents are always before their children, root distances and depths are computed forward
+		rootDists = [0.0]*nbNodes
+		depths = [0]*nbNodes
+		for i in range(1, nbNodes):
+			rootDists[i] = edgeLengths[i] + rootDists[parents[i]]
+			depths[i] = depths[parents[i]] + 1
+		self.rootDists = np.array(rootDists)
+		self.depths = np.array(depths, dtype=int)
+
+		# Ages, clade sizes and leaf counts are computed backward. As in dendropy's calc_node_ages,
+		# the age of a node is the one given by its first child, the tree not being checked for ultrametricity.
+		ages = [0.0]*nbNodes
+		firstChild = [-1]*nbNodes
+		cladeSizes = [1]*nbNodes
+		leafCounts = [1 if l else 0 for l in self.isLeaf.tolist()]
+		for i in range(nbNodes-1, 0, -1):
+			p = parents[i]
+			# Children are visited backward, the first one is visited last
+			firstChild[p] = i
+			cladeSizes[p] += cladeSizes[i]
+			leafCounts[p] += leafCounts[i]
+		for i in range(nbNodes-1, -1, -1):
+			if firstChild[i] >= 0:
+				ages[i] = ages[firstChild[i]] + edgeLengths[firstChild[i]]
+		self.ages = np.array(ages)
+		self.cladeSizes = np.array(cladeSizes, dtype=int)
+		self.cladeEnds = np.arange(nbNodes) + self.cladeSizes
+		self.leafCounts = np.array(leafCounts, dtype=int)
+
+		# Nodes by decreasing age as in dendropy's ageorder_node_iter, ties being kept in preorder, and their ranks
+		self.ageOrder = np.lexsort((np.arange(nbNodes), -self.ages))
+		self.ageRanks = np.empty(nbNodes, dtype=int)
+		self.ageRanks[self.ageOrder] = np.arange(nbNodes)
+
+		# Arrays are shared by all the users of the index, they must not be modified in place
+		for arr in [self.parents, self.edgeLengths, self.isLeaf, self.rootDists, self.depths, self.ages,
+				self.cladeSizes, self.cladeEnds, self.leafCounts, self.ageOrder, self.ageRanks]:
+			arr.flags.writeable = False
+
+	def GetNbNodes(self):
+		return len(self.nodes)
+
+	def GetInd(self, node):
+		return self.indices[node]
+
+	# True if node j is in the clade of node i
+	def IsInClade(self, j, i):
+		return i <= j < self.cladeEnds[i]
+
+	# Indices of the nodes of the clade of node i, in preorder
+	def GetClade(self, i):
+		return np.arange(i, self.cladeEnds[i])
+
+	# Indices of the nodes of the clade of node i by decreasing age, as in dendropy's ageorder_iter
+	def GetCladeByAge(self, i):
+		return self.ageOrder[np.sort(self.ageRanks[i:self.cladeEnds[i]])]
+
+	# Time elapsed since the start of the tree for each node
+	def GetTimes(self):
+		return self.rootTime + self.rootDists
+
+	# Time between the start of the tree and its furthest leaf
+	def GetHeight(self):
+		return self.rootTime + self.rootDists[self.isLeaf].max()
+
+	# Ages of the nodes counted back from the furthest leaf, the ages of nodes closer to the present than epsilon being 0.
+	# Contrary to ages, they are defined for non ultrametric trees (with extinct lineages).
+	def GetPresentAges(self, epsilon = 0.00001):
+		times = self.GetTimes()
+		ages = times.max() - times
+		ages[ages <= epsilon] = 0.0
+		return ages
+
+# Tree -> index, trees being weakly referenced so that indices do not keep them alive. Indices are not pickled with the trees.
+treeIndices = weakref.WeakKeyDictionary()
+
+# Returns the index of a tree, built on first access
+def getTreeIndex(t):
+	index = treeIndices.get(t)
+	if index is None:
+		index = TreeIndex(t)
+		treeIndices[t] = index
+	return index
+
+# Must be called after a tree has been modified (nodes added or removed, edge lengths changed) for its index to be rebuilt
+def invalidateTreeIndex(t):
+	treeIndices.pop(t, None)
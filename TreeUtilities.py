@@ -1,6 +1,9 @@
 import math
 
 import plotly.graph_objs as go
+import numpy as np
+from Utilities import *
+from TreeIndex import *
 
 import sys
 sys.setrecursionlimit(10000)
@@ -11,10 +14,14 @@ birthRateColorScale = [[0, 'rgb(0,0,131)'], [0.125, 'rgb(0,60,170)'],
 	[0.875, 'rgb(250,0,0)'], [1, 'rgb(128,0,0)']
 ]
 
+# Node plotters are numbered in preorder from the root plotter, which is also the order of the plotted points.
+# The clade of the plotter of index i is the preorder interval [i, cladeEnd), so that clade membership
+# is an interval test and finding a plotter from its index is a lookup in the list of the root.
 class NodePlotter:
 	def __init__(self, node, EdgePlotCls, parent = None, rateToDisplay = 'birth'):
 		self.node = node
 		self.parent = parent
+		self.root = self if parent is None else parent.root
 		if self.parent is None:
 			self.time = self.node.edge.length if self.node.edge.length is not None else 0
 		else:
@@ -34,6 +41,21 @@ class NodePlotter:
 		self.edge = EdgePlotCls(self.node.edge, self, self.parent, rateToDisplay = rateToDisplay)
 		self.rateToDisplay = rateToDisplay
 
+		if self.parent is None:
+			self._numberNodes()
+
+	# Sets the preorder index and the clade end of all the plotters of the tree, from the root
+	def _numberNodes(self):
+		self.allNodes = []
+		stack = [self]
+		while stack:
+			nd = stack.pop()
+			nd.ind = len(self.allNodes)
+			self.allNodes.append(nd)
+			stack += reversed(nd.children)
+		for nd in reversed(self.allNodes):
+			nd.cladeEnd = nd.children[-1].cladeEnd if len(nd.children) > 0 else nd.ind + 1
+
 	def ComputeAll(self):
 		# Positions
 		self.ComputePos()
@@ -59,22 +81,14 @@ class NodePlotter:
 			self.xpos = self.left + self.width / 2
 
 	def GetAllAttr(self, name):
-		res = [getattr(self, name) if hasattr(self, name) else None]
-		for c in self.children:
-			res += c.GetAllAttr(name)
-		return res
+		return [getattr(nd, name) if hasattr(nd, name) else None for nd in self.GetAllNodes()]
 
+	# Plotters of the clade, in preorder
 	def GetAllNodes(self):
-		res = [self]
-		for c in self.children:
-			res += c.GetAllNodes()
-		return res
+		return self.root.allNodes[self.ind:self.cladeEnd]
 	
 	def GetNodeFromInd(self, ind):
-		for nd in self.GetAllNodes():
-			if nd.node.cladeInd == ind:
-				return nd
-		return None
+		return self.root.allNodes[ind] if 0 <= ind < len(self.root.allNodes) else None
 
 	def GetColor(self):
 		return 'rgb(0,0,0)'
@@ -86,12 +100,8 @@ class NodePlotter:
 		return 'rgb(240, 240, 240)'
 
 	def IsInClade(self, cladeInd):
-		tmp = self
-		isInClade = False
-		while not isInClade and tmp is not None:
-			isInClade = (tmp.node.cladeInd == cladeInd)
-			tmp = tmp.parent
-		return isInClade
+		cld = self.GetNodeFromInd(cladeInd)
+		return cld is not None and cld.ind <= self.ind < cld.cladeEnd
 
 	def GetPlotElem(self, selectCladeInd = None):
 		allX = self.GetAllAttr('time')
@@ -100,11 +110,11 @@ class NodePlotter:
 			x=allX,
 			y=allY,
 			mode='markers',
-			marker=dict(color=[0 for v in self.GetAllAttr('time')], size=5, 
+			marker=dict(color=[0]*len(allX), size=5, 
 						colorscale=birthRateColorScale,showscale=True, cauto=False, 
 						cmin=self.minRate, cmax=self.maxRate if self.maxRate > self.minRate else 1,
 						colorbar = dict(title = self.rateToDisplay + ' rate', titleside = 'top')),
-			text=['node {}'.format(i) for i,n in enumerate(self.GetAllNodes())],
+			text=['node {}'.format(i) for i in range(len(allX))],
 			hoverinfo='',
 			name='allNodes'
 		)
@@ -192,12 +202,69 @@ class EdgePlotter:
 				allSegments.append(dict(x0=self.allTimes[i], x1=self.allTimes[i+1], y0=self.x, y1=self.x, type='line', layer='below', line=dict(color=self.GetColor(rate, minRate, maxRate, inClade),width=self.edgeWidth)))
 		return allSegments
 
+# Nodes, and the index of the selected clade, are numbered in preorder
 def PlotTreeInNewFig(tree, rateToDisplay = 'birth', selectCladeInd = None):
-	for i, nd in enumerate(tree):
-		nd.cladeInd = i
 	tp = NodePlotter(tree.seed_node, EdgePlotter, rateToDisplay=rateToDisplay)
 	tp.ComputeAll()
 	nodes, layout = tp.GetPlotElem(selectCladeInd = selectCladeInd)
 	return dict(data=nodes, layout=layout)
 
 
+
+
+###################
+# Tree statistics #
+###################
+
+# Array representation of a tree: nodes are in preorder, parents[i] is the index of the parent of node i (-1 for the root)
+# and always lower than i, edgeLengths[i] is the length of the edge leading to node i
+def GetTreeArrays(tree):
+	index = getTreeIndex(tree)
+	return index.parents, index.edgeLengths
+
+# Computes tree statistics from a dendropy tree in linear time
+def ComputeTreeStats(tree):
+	return ComputeTreeStatsFromArrays(*GetTreeArrays(tree))
+
+# Computes, in a single post-order pass over the array representation of a tree:
+# leaf counts of all clades, Colless and Sackin indices (normalized as the dendropy defaults)
+# and clade size distribution. Edge lengths are kept for the branch length histograms.
+def ComputeTreeStatsFromArrays(parents, edgeLengths):
+	n = len(parents)
+	par = parents.tolist()
+	leafCounts = [0]*n
+	nbChildren = [0]*n
+	firstChildLeaves = [0]*n
+	colless = 0
+	sackin = 0
+	bifurcating = True
+	# Children always have higher indices than their parents, going backwards visits them first
+	for i in range(n-1, -1, -1):
+		if nbChildren[i] == 0:
+			leafCounts[i] = 1
+		else:
+			# Each leaf of the clade has node i as ancestor
+			sackin += leafCounts[i]
+			bifurcating = bifurcating and nbChildren[i] == 2
+		p = par[i]
+		if p >= 0:
+			nbChildren[p] += 1
+			if nbChildren[p] == 1:
+				firstChildLeaves[p] = leafCounts[i]
+			else:
+				colless += abs(firstChildLeaves[p] - leafCounts[i])
+			leafCounts[p] += leafCounts[i]
+
+	stats = TmpObject()
+	stats.leafCounts = np.array(leafCounts, dtype=int)
+	stats.nbLeaves = leafCounts[0] if n > 0 else 0
+	nl = stats.nbLeaves
+	stats.collessRaw = colless if bifurcating else None
+	stats.colless = colless * 2.0 / (nl * (nl - 3) + 2) if bifurcating and nl * (nl - 3) + 2 != 0 else None
+	stats.sackinRaw = sackin
+	stats.sackin = sackin / nl if nl > 0 else 0
+	# Number of clades of each size, from 0 to nbLeaves
+	stats.cladeSizes = np.bincount(stats.leafCounts, minlength = nl + 1)
+
+	stats.edgeLengths = edgeLengths
+	return stats
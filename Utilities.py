@@ -1,5 +1,9 @@
 from abc import ABC, abstractmethod
 import copy
+import contextvars
+import hashlib
+import weakref
+from multiprocess import get_context
 
 # Parameter wrapper
 class Parameters:
@@ -23,10 +27,24 @@ class Parameters:
 				
 		return KeyTuple(sorted(kt, key=lambda x:x[0]))
 
+# Returns a stable 128 bits digest of a key tuple, usable as a file name
+def getFingerprint(kt):
+	return hashlib.blake2b(repr(kt).encode(), digest_size = 16).hexdigest()
+
 class KeyTuple(tuple):
 	def __init__(self, b):
 		tuple.__init__(tuple(b))
 
+	# Key tuples are used as dictionary keys over and over, their hash is thus only computed once
+	def __hash__(self):
+		if '_hash' not in self.__dict__:
+			self._hash = tuple.__hash__(self)
+		return self._hash
+
+	# String hashes differ between processes, the cached hash should never be pickled
+	def __reduce__(self):
+		return (KeyTuple, (tuple(self),))
+
 # Describe parameters for automatic UI generation
 class ParametersDescr:
 	def __init__(self, paramD = {}):
@@ -38,17 +56,25 @@ class ParametersDescr:
 		return Parameters(**{name : tup[0] for name, tup in self.description.items()})
 
 class NamedObject(ABC):
+	# Class name -> live instances indexed by unique name, weakly referenced so that the registry does not keep them alive
 	allInstances = {}
+	# Class name -> number of instances ever created, so that unique names are never reused
+	instanceCounts = {}
 
 	def __init__(self):
 		# Initialize unique name
 		if not hasattr(self, 'uniqueName'):
 			clsName = self.__class__.__name__
-			if clsName in NamedObject.allInstances:
-				NamedObject.allInstances[clsName].append(self)
-			else:
-				NamedObject.allInstances[clsName] = [self]
-			self.uniqueName = '{} {}'.format(clsName, len(NamedObject.allInstances[clsName]))
+			NamedObject.instanceCounts[clsName] = NamedObject.instanceCounts.get(clsName, 0) + 1
+			self.uniqueName = '{} {}'.format(clsName, NamedObject.instanceCounts[clsName])
+			if clsName not in NamedObject.allInstances:
+				NamedObject.allInstances[clsName] = weakref.WeakValueDictionary()
+			NamedObject.allInstances[clsName][self.uniqueName] = self
+
+	# Returns the number of live instances of each class
+	@staticmethod
+	def GetRegistrySizes():
+		return {clsName : len(insts) for clsName, insts in NamedObject.allInstances.items()}
 
 	# Returns a human readable unique name
 	def GetUniqueName(self):
@@ -58,12 +84,50 @@ class NamedObject(ABC):
 class Parameterizable(NamedObject):
 	def __init__(self, params = None):
 		NamedObject.__init__(self)
+		self._paramKeyTuple = None
+		self._fingerprints = {}
 		if params is None:
 			params = self.GetDefaultParams().getParams()
 		self.SetParameters(params)
+		self._modified = False
+
+	# Assigning a parameter invalidates the cached keys of the object and of all the objects that have it as parameter
+	def __setattr__(self, name, value):
+		if name in self.__dict__.get('_paramNames', ()):
+			oldVal = self.__dict__.get(name)
+			if isinstance(oldVal, Parameterizable) and oldVal is not value:
+				oldVal._getOwners().discard(self)
+			object.__setattr__(self, name, value)
+			if isinstance(value, Parameterizable):
+				value._getOwners().add(self)
+			self.SetModified()
+		else:
+			object.__setattr__(self, name, value)
+
+	# Owners are weakly referenced and not pickled, they register again when unpickled
+	def __getstate__(self):
+		return {k:v for k, v in self.__dict__.items() if k not in ['_owners', '_paramKeyTuple', '_fingerprints']}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._paramKeyTuple = None
+		self._fingerprints = {}
+		self.__dict__.setdefault('_modified', False)
+		for p in self._getParameterizableParams():
+			p._getOwners().add(self)
+
+	# Returns the objects that have self as parameter
+	def _getOwners(self):
+		if '_owners' not in self.__dict__:
+			self._owners = weakref.WeakSet()
+		return self._owners
 
 	def SetParameters(self, params):
 		self.params = params
+		if isinstance(params, Parameters):
+			self._paramNames = set(params.allParams.keys())
+		elif isinstance(params, KeyTuple):
+			self._paramNames = set(name for name, objName, vals in params)
 		if isinstance(params, Parameters):
 			for name, val in params.allParams.items():
 				setattr(self, name, val)
@@ -76,13 +140,46 @@ class Parameterizable(NamedObject):
 		else:
 			raise NotImplementedError()
 
+	# Cached until a parameter is assigned, parameters should thus not be modified in place
 	def GetParamKeyTuple(self):
-		newParam = Parameters(**{name:getattr(self, name) for name in self.GetDefaultParams().description.keys()})
-		return newParam.GetKeyTuple()
+		if self._paramKeyTuple is None:
+			newParam = Parameters(**{name:getattr(self, name) for name in self.GetDefaultParams().description.keys()})
+			self._paramKeyTuple = newParam.GetKeyTuple()
+		return self._paramKeyTuple
+
+	# Returns a stable 128 bits digest of the parameters, usable as a file name
+	def GetParamFingerprint(self):
+		return self._getCachedFingerprint('params', self.GetParamKeyTuple)
+
+	# Fingerprints of keys derived from the parameters are cached by name until a parameter is assigned
+	def _getCachedFingerprint(self, name, keyFunc):
+		if name not in self._fingerprints:
+			self._fingerprints[name] = getFingerprint(keyFunc())
+		return self._fingerprints[name]
 
 	def GetDefaultParams(self):
 		return ParametersDescr()
 
+	# Flags the object and the objects that have it as parameter as modified since they were last used in an analysis
+	def SetModified(self):
+		self._paramKeyTuple = None
+		self._fingerprints = {}
+		self._modified = True
+		for owner in list(self._getOwners()):
+			owner.SetModified()
+
+	# Returns True if the object or one of its Parameterizable parameters was modified
+	def IsModified(self):
+		return self._modified
+
+	def ClearModified(self):
+		self._modified = False
+		for p in self._getParameterizableParams():
+			p.ClearModified()
+
+	def _getParameterizableParams(self):
+		return [self.__dict__[name] for name in self.__dict__.get('_paramNames', ()) if isinstance(self.__dict__.get(name), Parameterizable)]
+
 	def CopyParamsFrom(self, other):
 		for name, val in self.GetDefaultParams().description.items():
 			p = getattr(self, name)
@@ -149,9 +246,9 @@ class Interfacable(NamedObject):
 
 # Parametrizable class that is linked to an app
 class AppParameterizable(Parameterizable):
-	def __init__(self):
+	def __init__(self, params = None):
 		self.appOwner = None
-		Parameterizable.__init__(self)
+		Parameterizable.__init__(self, params)
 
 	# Sets the subclass of GenericApp that owns it
 	def setAppOwner(self, appOwner):
@@ -169,6 +266,12 @@ class AppParameterizable(Parameterizable):
 class TmpObject(object):
 	pass
 
+# Returns a process pool whose workers are forked from a single threaded fork server instead of the calling process.
+# Pools are created from the worker threads of GenericApp.Analyze, and the children of a process forked while
+# other threads hold locks would inherit them locked. The main module of the app is imported once by the fork server.
+def getProcessPool(*args, **kwargs):
+	return get_context('forkserver').Pool(*args, **kwargs)
+
 # Utility class for Results
 class OwnedAttributeHolder:
 	def __init__(self, name, owner, value, sources):
@@ -181,11 +284,13 @@ class OwnedAttributeHolder:
 		return self.value
 
 	def __enter__(self):
-		# Sets a thread local class variable in Results that tracks which data are being used to make the new one
-		Results.usedSources.append(self)
+		# Sets a context local variable in Results that tracks which data are being used to make the new one
+		Results._usedSources.set(Results._usedSources.get() + (self,))
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		Results.usedSources.remove(self)
+		usedSources = list(Results._usedSources.get())
+		usedSources.remove(self)
+		Results._usedSources.set(tuple(usedSources))
 
 	def HasSameSourcesAs(self, other):
 		return set(self.sources) == set(other.sources if isinstance(other, OwnedAttributeHolder) else other)
@@ -209,9 +314,9 @@ class OwnedAttributeHolder:
 
 # Wraps results from a simulation
 class Results(object):
-	# thread-local list that tracks which sources are being used to synthesize data
-	# TODO make it thread local
-	usedSources = []#threading.local()
+	# Context-local tuple that tracks which sources are being used to synthesize data,
+	# each thread has its own so that several analyses can run concurrently
+	_usedSources = contextvars.ContextVar('usedSources', default = ())
 
 	def __init__(self, owner):
 		# Dict mapping attribute name -> list of owned attribute holders
@@ -219,6 +324,40 @@ class Results(object):
 		object.__setattr__(self, 'owner', owner)
 		#self.attributes = {}
 		#self.owner = owner
+		self._clearIndex()
+
+	# Indexes are not pickled nor deep copied, they are rebuilt instead since attribute holders are hashed by identity
+	def __getstate__(self):
+		return {k:v for k, v in self.__dict__.items() if k not in ['_index', '_ownerIndex', '_sourceIndex']}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.RebuildIndex()
+
+	def _clearIndex(self):
+		# (name, owner, frozenset of sources) -> owned attribute holder
+		object.__setattr__(self, '_index', {})
+		# (name, owner) -> list of owned attribute holders
+		object.__setattr__(self, '_ownerIndex', {})
+		# (name, source) -> list of owned attribute holders
+		object.__setattr__(self, '_sourceIndex', {})
+
+	def _addToIndex(self, oah):
+		self._index[(oah.name, oah.owner, frozenset(oah.sources))] = oah
+		self._ownerIndex.setdefault((oah.name, oah.owner), []).append(oah)
+		for s in set(oah.sources):
+			self._sourceIndex.setdefault((oah.name, s), []).append(oah)
+
+	def _append(self, oah):
+		self.attributes.setdefault(oah.name, []).append(oah)
+		self._addToIndex(oah)
+
+	# Call this after modifying the owner or the sources of held attributes
+	def RebuildIndex(self):
+		self._clearIndex()
+		for name, lst in self.attributes.items():
+			for oah in lst:
+				self._addToIndex(oah)
 
 	#def __add__(self, other):
 	#	res = Results()
@@ -232,16 +371,12 @@ class Results(object):
 	#	return res
 	def addResults(self, other):
 		for name, lst in other.attributes.items():
-			if name in self.attributes:
-				for oah in lst:
-					querry = self.GetOwnedAttr(name, lambda o: o.HasSameSourcesAs(oah) and o.owner == oah.owner)
-					if len(querry) > 0:
-						for q in querry:
-							q.value = oah.value
-					else:
-						self.attributes[name].append(oah)
-			else:
-				self.attributes[name] = copy.copy(lst)
+			for oah in lst:
+				existing = self._index.get((name, oah.owner, frozenset(oah.sources)))
+				if existing is not None:
+					existing.value = oah.value
+				else:
+					self._append(oah)
 
 	def ReOwn(self, newOner):
 		object.__setattr__(self, 'owner', newOner)
@@ -249,66 +384,79 @@ class Results(object):
 			for oah in lst:
 				oah.owner = newOner
 				oah.sources = []
+		self.RebuildIndex()
 
 	# Sets a new attribute or update an already existing attribute from the same owner
 	def __setattr__(self, name, value):
-		ah = OwnedAttributeHolder(name, self.owner, value, copy.copy(Results.usedSources))
-		if name in self.attributes:
-			modif = False
-			for h in self.attributes[name]:
-				if h.owner == self.owner and h.HasSameSourcesAs(ah):
-					h.value = value
-					modif = True
-					break
-			if not modif:
-				self.attributes[name].append(ah)
+		self.SetWithSources(name, value, list(Results._usedSources.get()))
+
+	# Same as setting an attribute but with explicitly given sources instead of the ones currently in use
+	def SetWithSources(self, name, value, sources):
+		existing = self._index.get((name, self.owner, frozenset(sources)))
+		if existing is not None:
+			existing.value = value
 		else:
-			self.attributes[name] = [ah]
+			self._append(OwnedAttributeHolder(name, self.owner, value, sources))
 
 	# Returns the attribute corresponding to the owner and the current sources
 	def __getattr__(self, name):
-		if name.startswith('__'):
-			return object.__getattr__(self, name)
+		if name.startswith('_'):
+			raise AttributeError(name)
 		else:
-			for h in self.attributes[name]:
-				if h.owner == self.owner and h.HasSameSourcesAs(Results.usedSources):
-					return h.value
+			h = self._index.get((name, self.owner, frozenset(Results._usedSources.get())))
+			if h is not None:
+				return h.value
 		raise Exception('Cannot directly access an attribute that is not owned by the Results object.')
-		
-	def GetOwnedAttr(self, name, filterFunc = lambda x:True, ind = None, defVal = None):
-		if name in self.attributes:
-			res = [oah for oah in self.attributes[name] if filterFunc(oah)]
-			if ind is None:
-				return res
-			elif ind < len(res):
-				return res[ind].GetValue()
-			else:
-				return defVal
-		else:
-			return [] if ind is None else defVal
 
-	def HasAttr(self, name, filterFunc = lambda x:True):
-		if not name in self.attributes:
-			return False
+	# The owner and source arguments restrict the search to attributes owned by owner and to attributes having source
+	# among their sources, they are looked up in indexes and should be preferred to equivalent filterFunc.
+	def GetOwnedAttr(self, name, filterFunc = lambda x:True, ind = None, defVal = None, owner = None, source = None):
+		if owner is not None:
+			candidates = self._ownerIndex.get((name, owner), [])
+			if source is not None:
+				candidates = [oah for oah in candidates if source in oah.sources]
+		elif source is not None:
+			candidates = self._sourceIndex.get((name, source), [])
+		else:
+			candidates = self.attributes.get(name, [])
+		res = [oah for oah in candidates if filterFunc(oah)]
+		if ind is None:
+			return res
+		elif ind < len(res):
+			return res[ind].GetValue()
 		else:
-			for oah in self.attributes[name]:
+			return defVal
+
+	# Returns a new Results object sharing the owned attribute holders that pass the filter
+	def Filter(self, filterFunc):
+		res = Results(self.owner)
+		for name, lst in self.attributes.items():
+			for oah in lst:
 				if filterFunc(oah):
-					return True
-			return False
-			
-		return name in self.attributes
+					res._append(oah)
+		return res
+
+	def HasAttr(self, name, filterFunc = lambda x:True):
+		return len(self.GetOwnedAttr(name, filterFunc)) > 0
 
 # Holds a reference, useful when a Parameterizable object has a parameter that can link 
 # to several different objects, without owning these objects
 class ReferenceHolder:
-	allRefs = {}
+	# Unique name -> held object, weakly referenced so that holding a reference does not keep objects alive
+	allRefs = weakref.WeakValueDictionary()
 
 	def __init__(self, val):
 		if type(val) == str:
-			self.value = ReferenceHolder.allRefs[val]
+			self.value = None if val == 'EmptyReferenceHolder' else ReferenceHolder.allRefs[val]
 		else:
 			self.value = val
-			ReferenceHolder.allRefs[str(self)] = self.value
+			if self.value is not None:
+				ReferenceHolder.allRefs[str(self)] = self.value
+
+	# Returns the number of live objects that can be looked up by unique name
+	@staticmethod
+	def GetRegistrySize():
+		return len(ReferenceHolder.allRefs)
 	
 	def __repr__(self):
 		if self.value is None:
@@ -329,3 +477,18 @@ class ResultHolder:
 	def SetResults(self, res):
 		self.results = res
 
+# Abstract base class for the plotters of the testing apps, the attributes of the plotted results are read as attributes of the plotter
+class ResultPlotter(ResultHolder, ABC):
+	def __init__(self, res):
+		self.SetResults(res)
+
+	def __getattr__(self, name):
+		if name.startswith('_') or name == 'results':
+			raise AttributeError(name)
+		return getattr(self.results, name)
+
+	# Returns the axes to display
+	@abstractmethod
+	def Plot(self):
+		pass
+
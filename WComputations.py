@@ -1,11 +1,107 @@
 import math
+import numpy as np
+from TreeIndex import *
 
 ###############
 # W computing #
 ###############
 
+# Number of lineages of a tree at any distance from the root, as given by dendropy's num_lineages_at,
+# but using binary searches in the sorted root distances of the tree index.
+class LineageProfile:
+	def __init__(self, t):
+		index = getTreeIndex(t)
+		dists = index.rootDists[1:]
+		parentDists = index.rootDists[index.parents[1:]]
+		self.dists = np.sort(dists)
+		self.parentDists = np.sort(parentDists)
+		self.zeroEdgeDists = np.sort(dists[dists == parentDists])
+
+	# Lineages at distance d are the nodes at distance d and the nodes after d whose parent is before d
+	def GetNbLineagesAt(self, distances):
+		d = np.asarray(distances, dtype=float)
+		nbAt = np.searchsorted(self.dists, d, side='right') - np.searchsorted(self.dists, d, side='left')
+		nbParentBefore = np.searchsorted(self.parentDists, d, side='left')
+		nbAtOrBefore = np.searchsorted(self.dists, d, side='right')
+		# Nodes with a zero length edge at distance d have their parent at d as well
+		nbZeroEdgeAt = np.searchsorted(self.zeroEdgeDists, d, side='right') - np.searchsorted(self.zeroEdgeDists, d, side='left')
+		return nbAt + nbParentBefore - nbAtOrBefore + nbZeroEdgeAt
+
 def computeW(t, n):
-	t.calc_node_ages() # Required for "ageorder_node_iter"
+	index = getTreeIndex(t)
+	nodes = index.GetCladeByAge(index.GetInd(n))
+	# Position of the first node strictly younger than each node, nodes being sorted by decreasing age
+	ages = index.ages[nodes]
+	nextPos = np.searchsorted(-ages, -ages, side='right')
+
+	internals = np.flatnonzero(~index.isLeaf[nodes])
+	nextNodes = np.where(nextPos[internals] < len(nodes), nodes[np.minimum(nextPos[internals], len(nodes)-1)], nodes[internals])
+	allT_i = (index.rootDists[nodes[internals]] + index.rootDists[nextNodes])/2.0
+	allNbLineages = LineageProfile(t).GetNbLineagesAt(allT_i)
+
+	# Same summation order as computeWNaive so that results are identical
+	W_num = 0.0
+	W_den = 0.0
+	parents = index.parents.tolist()
+	isLeaf = index.isLeaf.tolist()
+	for n_i, next_node, nbLin in zip(nodes[internals].tolist(), nextNodes.tolist(), allNbLineages.tolist()):
+		p_i = 2.0/nbLin
+		X_i = 1.0 if ((parents[next_node] == n_i) and not isLeaf[next_node]) else 0.0
+
+		W_num += X_i - p_i
+		W_den += p_i*(1.0-p_i)
+
+	n.W_score = W_num / math.sqrt(W_den) if (W_den > 0) else 0.0
+	return n.W_score
+
+# Computes W for every clade of the tree at once and returns the scores in preorder (0 for leaves).
+# All nodes are sorted by age once in the tree index, the age ordered nodes of each clade are then obtained by merging
+# the ones of its children bottom-up, and the lineage profile of the tree is shared by all clades.
+# Terms are summed in the same order as in computeW so that scores are identical.
+def computeAllW(t):
+	index = getTreeIndex(t)
+	nodes = index.nodes
+	indices = index.indices
+	parents = index.parents
+	isInternal = ~index.isLeaf
+	ages = index.ages
+	rootDists = index.rootDists
+	profile = LineageProfile(t)
+
+	# Rank of each node in the decreasing age order of ageorder_iter, ties being kept in preorder
+	order = index.ageOrder
+	ranks = index.ageRanks
+
+	W = np.zeros(len(nodes))
+	# Ranks of the nodes of each clade whose parent was not processed yet
+	cladeRanks = {}
+	for i in range(len(nodes)-1, -1, -1):
+		if not isInternal[i]:
+			cladeRanks[i] = np.array([ranks[i]])
+			continue
+		childRanks = [cladeRanks.pop(indices[c]) for c in nodes[i].child_node_iter()]
+		clade = order[np.sort(np.concatenate([[ranks[i]]] + childRanks))]
+		cladeRanks[i] = ranks[clade]
+
+		# First node of the clade strictly younger than each node, or the node itself
+		cladeAges = ages[clade]
+		nextPos = np.searchsorted(-cladeAges, -cladeAges, side='right')
+		nextNodes = np.where(nextPos < len(clade), clade[np.minimum(nextPos, len(clade)-1)], clade)
+
+		internals = isInternal[clade]
+		n_i = clade[internals]
+		next_node = nextNodes[internals]
+		p_i = 2.0 / profile.GetNbLineagesAt((rootDists[n_i] + rootDists[next_node]) / 2.0)
+		X_i = ((parents[next_node] == n_i) & isInternal[next_node]).astype(float)
+		W_num = sum((X_i - p_i).tolist(), 0.0)
+		W_den = sum((p_i * (1.0 - p_i)).tolist(), 0.0)
+		W[i] = W_num / math.sqrt(W_den) if W_den > 0 else 0.0
+	return W
+
+# Previous quadratic implementation of computeW, kept to check the results of the faster one
+def computeWNaive(t, n):
+	# Required for "ageorder_node_iter", trees with extinct lineages get the ages of the tree index
+	t.calc_node_ages(ultrametricity_precision=False)
 	t.calc_node_root_distances(return_leaf_distances_only=False) # Required for "num_lineages_at"
 
 	nodes = list(n.ageorder_iter(include_leaves=True,descending=True))
@@ -31,7 +127,14 @@ def computeW(t, n):
 # W2 computing #
 ################
 
+# Computes W2 for clade c with the tree index, see computeW2Batch
 def computeW2(t, c):
+	return computeW2Batch(t, [c])[0]
+
+# Previous implementation of computeW2, that stores its intermediate values in the nodes,
+# kept to check the results of the faster one
+def computeW2Naive(t, c):
+	t.calc_node_ages() # Required for "ageorder_node_iter"
 	nbAlive = 0
 	prevList = []
 	for n in t.ageorder_node_iter(include_leaves = True, descending = True):
@@ -94,8 +197,146 @@ def computeW2(t, c):
 
 	c.W2_numJules = num
 	c.W2_denJules = den
+	c.W2_pi = [n.p_i for n in t.ageorder_node_iter(include_leaves = True, descending = True, filter_fn = lambda x: x.age < c.age)]
 	return num / math.sqrt(den) if den > 0 else 0
 
+# Lineage counts of computeW2Naive for nodes sorted by decreasing age: all nodes of a group of equal ages get the count
+# reached at the end of the group, the last group getting one more lineage if it has several nodes
+def getW2NbAlive(ages, deltas):
+	cum = np.cumsum(deltas)
+	groupEnds = np.searchsorted(-ages, -ages, side='right') - 1
+	nbAlive = cum[groupEnds]
+	lastGroup = groupEnds == len(ages) - 1
+	if np.count_nonzero(lastGroup) > 1:
+		nbAlive[lastGroup] += 1
+	return nbAlive
+
+# Yields the W2 numerator, denominator and the p_i of all nodes younger than the clade (None if withPi is False)
+# for each clade of the tree. The global lineage counts are computed once, and the out of clade terms, whose p_i
+# is constant between two consecutive nodes of the clade, are summed with prefix sums over the age ordered nodes
+# of the tree, so that the cost of each clade only depends on its size.
+# Ages can be given as an array in the preorder of the tree index, the ages of the index are used otherwise.
+def iterW2Batch(t, clades, withPi = True, ages = None):
+	index = getTreeIndex(t)
+	cladeInds = [index.GetInd(c) for c in clades]
+	if ages is None:
+		return iterW2BatchFromArrays(index.parents, index.isLeaf, index.ages, cladeInds, withPi,
+			cladeSizes = index.cladeSizes, order = index.ageOrder)
+	return iterW2BatchFromArrays(index.parents, index.isLeaf, np.asarray(ages), cladeInds, withPi, cladeSizes = index.cladeSizes)
+
+# Same as iterW2Batch for a tree given as arrays in preorder: parent indices (-1 for the root), leaf flags and ages.
+# Clades are given by the index of their root.
+# Nodes after which a single lineage is left have no defined p_i (computeW2Naive fails on them), they are left out.
+# Clade sizes and the age order of the nodes are computed if they are not given.
+def iterW2BatchFromArrays(parents, isLeaf, ages, cladeInds, withPi = True, cladeSizes = None, order = None):
+	nbNodes = len(parents)
+	deltas = np.where(ages > 0, np.where(isLeaf, -1, 1), 0)
+	if cladeSizes is None:
+		cladeSizes = np.ones(nbNodes, dtype=int)
+		for i in range(nbNodes-1, 0, -1):
+			cladeSizes[parents[i]] += cladeSizes[i]
+
+	# Nodes in the order of ageorder_node_iter, ties being kept in preorder
+	if order is None:
+		order = np.lexsort((np.arange(nbNodes), -ages))
+	ranks = np.empty(nbNodes, dtype=int)
+	ranks[order] = np.arange(nbNodes)
+	sortedAges = ages[order]
+	nbAlive = np.empty(nbNodes)
+	nbAlive[order] = getW2NbAlive(sortedAges, deltas[order])
+
+	# Out of clade contributions for a p_i of 1/nbAlive, the actual ones being proportional to the clade lineage count
+	invAlive = np.zeros(nbNodes)
+	invAlive[nbAlive[order] > 0] = 1.0 / nbAlive[order][nbAlive[order] > 0]
+	numPrefix = np.concatenate(([0.0], np.cumsum(np.where(isLeaf[order], invAlive, -invAlive))))
+	piPrefix = np.concatenate(([0.0], np.cumsum(invAlive)))
+	pi2Prefix = np.concatenate(([0.0], np.cumsum(invAlive**2)))
+
+	for i in cladeInds:
+		cAge = ages[i]
+		clade = order[np.sort(ranks[i:i+cladeSizes[i]])]
+		nbClade = getW2NbAlive(ages[clade], deltas[clade])
+
+		# Contribution of the nodes of the clade, c being the first one
+		defined = nbAlive[clade[1:]] > 0
+		pi = nbClade[1:][defined] / nbAlive[clade[1:]][defined]
+		num = np.sum(np.where(isLeaf[clade[1:]][defined], pi - 1, 1 - pi))
+		den = np.sum(pi * (1 - pi))
+
+		# Contribution of the nodes out of the clade, between consecutive younger nodes of the clade
+		start = np.searchsorted(-sortedAges, -cAge, side='right')
+		isYounger = ages[clade] < cAge
+		younger = clade[isYounger]
+		bounds = np.concatenate(([start], ranks[younger] + 1))
+		ends = np.concatenate((ranks[younger], [nbNodes]))
+		cladeAlive = np.concatenate(([2], nbClade[isYounger] + deltas[younger]))
+		num += np.sum(cladeAlive * (numPrefix[ends] - numPrefix[bounds]))
+		den += np.sum(cladeAlive * (piPrefix[ends] - piPrefix[bounds]) - cladeAlive**2 * (pi2Prefix[ends] - pi2Prefix[bounds]))
+
+		allPi = None
+		if withPi:
+			allPi = np.repeat(cladeAlive, ends - bounds + 1)[:nbNodes - start] * invAlive[start:]
+			allPi[ranks[younger] - start] = nbClade[isYounger] * invAlive[ranks[younger]]
+		yield num, den, allPi
+
+# Computes W2 for several clades of a tree at once (all internal nodes by default) with iterW2Batch and returns
+# the scores. Numerators and denominators are stored in the clades as in computeW2Naive, as well as the p_i of all
+# nodes younger than the clade if storePi is True.
+def computeW2Batch(t, clades = None, storePi = True, ages = None):
+	if clades is None:
+		clades = [nd for nd in t.preorder_node_iter() if nd.is_internal()]
+	res = np.zeros(len(clades))
+	for k, (c, (num, den, allPi)) in enumerate(zip(clades, iterW2Batch(t, clades, storePi, ages))):
+		c.W2_numJules = num
+		c.W2_denJules = den
+		if storePi:
+			c.W2_pi = allPi
+		res[k] = num / math.sqrt(den) if den > 0 else 0
+	return res
+
+# Returns the preorder of a tree given by the parent of each node (-1 for the root), children being visited by increasing index
+def getPreorderFromParents(parents):
+	parents = np.asarray(parents)
+	# Children of node i are byParent[childStarts[i]:childStarts[i+1]], by increasing index
+	byParent = np.argsort(parents, kind='stable')
+	childStarts = np.searchsorted(parents[byParent], np.arange(len(parents) + 1))
+	byParent = byParent.tolist()
+	childStarts = childStarts.tolist()
+	order = []
+	stack = [int(np.flatnonzero(parents < 0)[0])]
+	while stack:
+		i = stack.pop()
+		order.append(i)
+		stack += reversed(byParent[childStarts[i]:childStarts[i+1]])
+	return np.array(order)
+
+# Maximum number of Bernoulli draws done at once by drawBernoulliW2
+maxDrawMatrixSize = 10**7
+
+# Draws nbReplicates Bernoulli surrogate W2 values from the p_i of the nodes younger than a clade.
+# Each node is drawn in the clade with probability p_i, the draws being done as a replicates x nodes matrix.
+# Only the numerator depends on the draws: it is the number of nodes drawn in the clade minus the sum of the p_i.
+def drawBernoulliW2(pis, nbReplicates, rng = None):
+	rng = np.random.default_rng() if rng is None else rng
+	pis = np.asarray(pis, dtype=float)
+	den = np.sum(pis * (1.0 - pis))
+	if not den > 0:
+		return np.zeros(nbReplicates)
+	nbDrawn = np.zeros(nbReplicates)
+	chunkSize = max(1, maxDrawMatrixSize // max(1, len(pis)))
+	for s in range(0, nbReplicates, chunkSize):
+		e = min(nbReplicates, s + chunkSize)
+		nbDrawn[s:e] = np.count_nonzero(rng.random((e - s, len(pis))) < pis, axis = 1)
+	return (nbDrawn - np.sum(pis)) / math.sqrt(den)
+
+# Two-sided empirical p-value of a W2 value among surrogate W2 values
+def getSurrogatePValue(w2, surrW2):
+	if not math.isfinite(w2):
+		return math.nan
+	surrW2 = np.asarray(surrW2)
+	nbTail = min(np.count_nonzero(surrW2 >= w2), np.count_nonzero(surrW2 <= w2))
+	return min(1.0, 2.0 * (1 + nbTail) / (len(surrW2) + 1))
+
 #class BernoulliSurrogateStratPri(Parameterizable):
 #	def generate(self, tree, clade):
 #		W2_num = sum(1.0-p_i if random.random() < p_i else -p_i for p_i in clade.W2_pi)
@@ -3,24 +3,26 @@ import matplotlib
 import matplotlib.pyplot as plt
 from TreeGenerators import *
 from WComputations import *
+from ROCComputations import *
 from Utilities import *
+from Simulations import *
 
 class WROCTestingSimRunner(SimulationRunner):
 	def GetDefaultParams(self):
 		return ParametersDescr({
 			'nb_tree' : (10, int),
-			'tree_size' : (20, int),
+			'endCondition' : (NumExtantStopCrit(), StoppingCriteria),
 			'treeGenerator' : (NeutralTreeGenerator(), TreeGenerator)
 		})
 
 	def Simulate(self):
-		res = Results()
+		res = Results(self)
 		res.Wvals = []
 		res.stats = {}
 
 		for i in range(self.nb_tree):
 			# Generate tree
-			t = self.treeGenerator.generate(self.tree_size)
+			t, rej = treeGenSimFunc((self.endCondition, self.treeGenerator))
 			res.Wvals.append(computeW(t, t.seed_node))
 
 		# Compute stats
@@ -31,23 +33,20 @@ class WROCTestingSimRunner(SimulationRunner):
 		return res
 
 class WROCPlotter(ResultPlotter):
+	# Fraction of neutral (true positives) and non neutral (false positives) W values inside the central intervals of
+	# the neutral W values, for all interval levels, and bootstrap bands of the curve
 	def getROCVals(self, n, nn):
-		truePos = []
-		falsePos = []
-		for pval in np.arange(0, 1.01, 0.01):
-			minv, maxv = n[int(pval/2*len(n))], n[-int(pval/2*len(n))-1]
-			filtN = list(filter(lambda x: minv <= x <= maxv, n))
-			filtNn = list(filter(lambda x: minv <= x <= maxv, nn))
-			truePos.append(len(filtN) / len(n))
-			falsePos.append(len(filtNn) / len(nn))
-		return truePos, falsePos
+		nPVals = getTwoSidedPValues(n, n)
+		nnPVals = getTwoSidedPValues(n, nn)
+		falsePos, truePos = computeROC(nPVals, nnPVals)
+		return truePos, falsePos, bootstrapROC(nPVals, nnPVals)
 
 	def Plot(self):
 		fig, ax = plt.subplots(2, 2, figsize=(14,10))
 
 		n = sorted(self.neutral.Wvals)
 		nn = sorted(self.nonneutral.Wvals)
-		truePos, falsePos = self.getROCVals(n, nn)
+		truePos, falsePos, bands = self.getROCVals(n, nn)
 
 		allMin = min(min(n), min(nn))
 		allMax = max(max(n), max(nn))
@@ -62,10 +61,12 @@ class WROCPlotter(ResultPlotter):
 		ax[0][1].set_xlabel('W score')
 		ax[0][1].set_title('W score of Non Neutral Trees')
 
+		ax[1][1].fill_between(bands.falsePos, bands.low, bands.high, color='r', alpha=0.2)
 		ax[1][1].plot(falsePos, truePos, 'r')
 		ax[1][1].plot([0, 1], [0, 1], '-k')
 		ax[1][1].set_ylabel('True positives')
 		ax[1][1].set_xlabel('False positives')
-		ax[1][1].set_title('ROC curve')
+		aucLow, aucHigh = np.quantile(bands.aucs, [0.05, 0.95])
+		ax[1][1].set_title('ROC curve, AUC: {:.3f} [{:.3f}, {:.3f}]'.format(computeAUC(falsePos, truePos), aucLow, aucHigh))
 
 		return ax[0][0]
@@ -11,9 +11,9 @@ class WROCTestingApp(server.App):
 				type = 'dropdown',
 				label = 'Non-neutral tree generator',
 				options = [
-					{"label": "Neutral Tree", "value":"NeutralTreeGenerator(Parameters(birth_rate=1, death_rate=0))", "checked":True},
-					{"label":"Explosive Radiation", "value":"NonNeutralTreeGenerator(Parameters(rf = ExplosiveRadiationRateFunc(Parameters(timeDelay=0.1, basalRate=2, lowRate=0.05))))"},
-					{"label":"Trait Evolution Linear Brownian", "value":"NonNeutralTreeGenerator(Parameters(rf=TraitEvolLinearBrownian(Parameters(basalRate=1, sigma=0.8, lowestRate=0.01))))"}
+					{"label": "Neutral Tree", "value":"NeutralTreeGenerator(Parameters(birth_rate=1.0, death_rate=0.0))", "checked":True},
+					{"label":"Explosive Radiation", "value":"RateFunctionTreeGenerator(Parameters(birth_rf = ExplosiveRadiationRateFunc(Parameters(timeDelay=0.1, basalRate=2, lowRate=0.05)), death_rf = ConstantRateFunction(Parameters(rate=0.0))))"},
+					{"label":"Trait Evolution Linear Brownian", "value":"RateFunctionTreeGenerator(Parameters(birth_rf = TraitEvolLinearBrownian(Parameters(basalRate=1, sigma=0.8, lowestRate=0.01)), death_rf = ConstantRateFunction(Parameters(rate=0.0))))"}
 				],
 				key = 'treeGenerator'),
 			dict(
@@ -43,16 +43,16 @@ class WROCTestingApp(server.App):
 	def GetParams(self, params):
 		params = Parameters(
 			nb_tree = int(params['nbTrees']),
-			tree_size = int(params['treeSize']),
+			endCondition = NumExtantStopCrit(Parameters(num_extant_tips = int(params['treeSize']))),
 			treeGenerator = eval(params['treeGenerator']))
 		return params
 
 	def ROCPlot(self, params):
 		params = self.GetParams(params)
 
-		neutTreeGen = NeutralTreeGenerator(Parameters(birth_rate=1, death_rate=0))
+		neutTreeGen = NeutralTreeGenerator(Parameters(birth_rate=1.0, death_rate=0.0))
 
-		allRes = Results()
+		allRes = Results(self)
 		allRes.nonneutral = SimManager.GetSimulationResult(WROCTestingSimRunner(params))
 		SimManager.SaveSimulations()
 
@@ -66,5 +66,7 @@ class WROCTestingApp(server.App):
 		
 
 app = WROCTestingApp()
-app.launch()
+# Process pool workers import this module without launching the app
+if __name__ == '__main__':
+	app.launch()
 
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from ROCComputations import *
+
+# ROC curve computed by the W and W2 ROC plotters before computeROC: fractions of neutral (true positives) and
+# non neutral (false positives) values inside the central intervals of the sorted neutral values, for 101 levels
+def getROCValsNaive(n, nn):
+	truePos = []
+	falsePos = []
+	for pval in np.arange(0, 1.01, 0.01):
+		minv, maxv = n[int(pval/2*len(n))], n[-int(pval/2*len(n))-1]
+		truePos.append(len([x for x in n if minv <= x <= maxv]) / len(n))
+		falsePos.append(len([x for x in nn if minv <= x <= maxv]) / len(nn))
+	return truePos, falsePos
+
+def getSamples(nbNeutral, nbNonNeutral, rounded):
+	rng = np.random.default_rng(1234)
+	n = rng.normal(size = nbNeutral)
+	nn = rng.normal(0.3, 1.6, size = nbNonNeutral)
+	if rounded:
+		# Ties between and within samples
+		n, nn = np.round(n, 1), np.round(nn, 1)
+	return sorted(n), nn
+
+@pytest.mark.parametrize('nbNeutral, nbNonNeutral, rounded', [(200, 150, False), (101, 300, True), (57, 57, True)])
+def test_computeROC_contains_naive_points(nbNeutral, nbNonNeutral, rounded):
+	n, nn = getSamples(nbNeutral, nbNonNeutral, rounded)
+	falsePos, truePos = computeROC(getTwoSidedPValues(n, n), getTwoSidedPValues(n, nn))
+	points = set(zip(falsePos.tolist(), truePos.tolist()))
+	for tp, fp in zip(*getROCValsNaive(n, nn)):
+		assert (fp, tp) in points
+	assert (falsePos[0], truePos[0]) == (0, 0)
+	assert (falsePos[-1], truePos[-1]) == (1, 1)
+	assert np.all(np.diff(falsePos) >= 0) and np.all(np.diff(truePos) >= 0)
+
+@pytest.mark.parametrize('rounded', [False, True])
+def test_computeAUC_matches_mann_whitney(rounded):
+	n, nn = getSamples(80, 60, rounded)
+	pos = getTwoSidedPValues(n, n)
+	neg = getTwoSidedPValues(n, nn)
+	mannWhitney = np.mean([(a > b) + 0.5 * (a == b) for a in pos for b in neg])
+	assert computeAUC(*computeROC(pos, neg)) == pytest.approx(mannWhitney, abs = 1e-12)
+
+def test_bootstrapROC_brackets_exact_curve():
+	n, nn = getSamples(300, 300, False)
+	pos = getTwoSidedPValues(n, n)
+	neg = getTwoSidedPValues(n, nn)
+	falsePos, truePos = computeROC(pos, neg)
+	bands = bootstrapROC(pos, neg, 500, rng = np.random.default_rng(0))
+	# True positive fraction of the exact curve at the highest threshold allowed by each grid value
+	exact = np.array([truePos[falsePos <= f + 1e-12].max() for f in bands.falsePos])
+	assert np.all(bands.low <= bands.high)
+	assert np.max(np.abs(bands.mean - exact)) < 0.1
+	assert np.quantile(bands.aucs, 0.01) < computeAUC(falsePos, truePos) < np.quantile(bands.aucs, 0.99)
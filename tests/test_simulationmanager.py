@@ -0,0 +1,40 @@
+import os
+from SimulationManager import *
+from Simulations import *
+
+def getSimulation(nbTrees, nbTips = 10):
+	return TreeStatSimulation(Parameters(endCondition = NumExtantStopCrit(Parameters(num_extant_tips = nbTips)), nb_tree = nbTrees,
+		treeGenerator = NeutralTreeGenerator(Parameters(birth_rate = 1.0, death_rate = 0.0))))
+
+def test_fingerprints_are_cached_and_invalidated():
+	sim = getSimulation(3)
+	fingerprint = sim.GetParamFingerprint()
+	assert sim.GetParamFingerprint() is fingerprint
+	assert sim.GetMemoKeyTuple() == ('TreeStatSimulation', fingerprint)
+	assert getSimulation(3).GetMemoKeyTuple() == sim.GetMemoKeyTuple()
+	# Modifying a nested parameter invalidates the fingerprints of its owners
+	sim.endCondition.num_extant_tips = 11
+	assert sim.GetParamFingerprint() != fingerprint
+	assert sim.GetMemoKeyTuple() == getSimulation(3, 11).GetMemoKeyTuple()
+
+def test_ensemble_key_ignores_replicates(tmp_path):
+	manager = SimulationManager(str(tmp_path / 'sims.pkl'))
+	assert manager.GetKeyTuple(getSimulation(3)) == manager.GetKeyTuple(getSimulation(7))
+	assert getSimulation(3).GetMemoKeyTuple() != getSimulation(7).GetMemoKeyTuple()
+	assert manager.GetKeyTuple(getSimulation(3)) != manager.GetKeyTuple(getSimulation(3, 11))
+
+def test_memoized_ensembles_are_topped_up(tmp_path):
+	manager = SimulationManager(str(tmp_path / 'sims.pkl'))
+	first = manager.GetSimulationResult(getSimulation(3), True)
+	assert len(first.trees) == 3
+	kt = manager.GetKeyTuple(getSimulation(3))
+	assert os.path.exists(manager._getKeyLockPath(kt))
+	assert os.path.basename(manager._getKeyLockPath(kt)) == '{}.lock'.format(getFingerprint(kt))
+
+	# Another manager reads the saved ensemble and tops it up
+	other = SimulationManager(str(tmp_path / 'sims.pkl'))
+	more = other.GetSimulationResult(getSimulation(5), True)
+	assert len(more.trees) == 5
+	assert [t.as_string(schema = 'newick') for t in more.trees[:3]] == [t.as_string(schema = 'newick') for t in first.trees]
+	assert len(SimulationManager(str(tmp_path / 'sims.pkl')).GetSimulationResult(getSimulation(2), True).trees) == 2
+	assert list(SimulationManager(str(tmp_path / 'sims.pkl')).simulations.keys()) == [kt]
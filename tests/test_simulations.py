@@ -0,0 +1,18 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from Simulations import *
+
+def getNbExtant(t):
+	return len([n for n in t.leaf_node_iter() if not getattr(n, 'is_extinct', False)])
+
+# Simulations of GenericApp.Analyze create their process pools from worker threads, while other threads hold locks
+def test_simulations_from_worker_threads():
+	sims = [TreeStatSimulation(Parameters(endCondition = NumExtantStopCrit(Parameters(num_extant_tips = 15)), nb_tree = 20,
+		treeGenerator = NeutralTreeGenerator(Parameters(birth_rate = 1.0, death_rate = 0.2)))) for i in range(3)]
+	heldLock = threading.Lock()
+	with heldLock, ThreadPoolExecutor(max_workers = len(sims)) as pool:
+		futures = [pool.submit(sim.Simulate) for sim in sims]
+		allRes = [f.result(timeout = 120) for f in futures]
+	for res in allRes:
+		assert len(res.trees) == 20
+		assert all(getNbExtant(t) == 15 for t in res.trees)
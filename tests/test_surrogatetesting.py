@@ -0,0 +1,92 @@
+import copy
+import random
+import dendropy
+import numpy as np
+import pytest
+from scipy.stats import ks_2samp
+from dendropy.simulate import treesim
+from SurrogateTesting import *
+
+def getRandomTrees(nbTrees = 3, nbTips = 30):
+	rng = random.Random(1234)
+	return [treesim.birth_death_tree(birth_rate = 1.0, death_rate = 0.0, num_extant_tips = nbTips, rng = rng) for i in range(nbTrees)]
+
+def getClades(t):
+	t.calc_node_ages()
+	return [nd for nd in t.ageorder_node_iter(include_leaves = False, descending = True) if nd.parent_node is not None][2:8:2]
+
+# Builds the dendropy tree described by preorder arrays
+def getTreeFromArrays(parents, ages):
+	t = dendropy.Tree(taxon_namespace = dendropy.TaxonNamespace())
+	nodes = [t.seed_node]
+	for i in range(1, len(parents)):
+		nodes.append(nodes[parents[i]].new_child())
+		nodes[i].edge.length = ages[parents[i]] - ages[i]
+	return t, nodes
+
+# Surrogate computed by SimulatedNeutralSurrogate before regrowCutTree, that cuts and regrows a copy of the tree
+def simulatedNeutralW2Naive(t, clade):
+	t = copy.deepcopy(t)
+	clade = [nd for nd in t.preorder_node_iter() if nd.label == clade.label][0]
+	nb_tips = len(t.leaf_nodes())
+	t_i = clade.age
+	for n in list(t.ageorder_node_iter(include_leaves=True, descending=False)):
+		if n.age >= t_i:
+			break
+		else:
+			p = n.parent_node
+			if p.age > t_i:
+				n.edge_length = n.parent_node.age - t_i
+			else:
+				p.remove_child(n, suppress_unifurcations=False)
+	while len(t.leaf_nodes()) < nb_tips:
+		evolved_tip = random.choice(t.leaf_nodes())
+		ch1 = evolved_tip.new_child()
+		ch2 = evolved_tip.new_child()
+		ch1.edge.length = 0.0
+		ch2.edge.length = 0.0
+		for tip in t.leaf_nodes():
+			tip.edge.length += 1
+	return computeW2Naive(t, clade)
+
+def test_regrown_arrays_match_dendropy():
+	rng = np.random.default_rng(1234)
+	for t in getRandomTrees():
+		for clade in getClades(t):
+			cut = getCutTreeArrays(t, clade)
+			for r in range(5):
+				parents, isLeaf, ages, cladeInd = regrowCutTree(cut, rng)
+				regrown, nodes = getTreeFromArrays(parents, ages)
+				assert len(regrown.leaf_nodes()) == len(t.leaf_nodes())
+				assert [nd.is_leaf() for nd in nodes] == isLeaf.tolist()
+				for num, den, allPi in iterW2BatchFromArrays(parents, isLeaf, ages, [cladeInd], withPi = False):
+					w2 = num / math.sqrt(den) if den > 0 else 0
+					assert w2 == pytest.approx(computeW2Naive(regrown, nodes[cladeInd]), abs = 1e-12)
+
+def test_simulated_surrogate_does_not_modify_tree():
+	t = getRandomTrees(nbTrees = 1)[0]
+	clade = getClades(t)[0]
+	before = t.as_string(schema = 'newick')
+	SimulatedNeutralSurrogate().generateMany(t, clade, 20)
+	assert t.as_string(schema = 'newick') == before
+
+def test_simulated_surrogate_matches_naive():
+	random.seed(1234)
+	t = getRandomTrees(nbTrees = 1)[0]
+	for i, nd in enumerate(t.preorder_node_iter()):
+		nd.label = str(i)
+	clade = getClades(t)[1]
+	naive = [simulatedNeutralW2Naive(t, clade) for i in range(300)]
+	assert ks_2samp(simulatedNeutralW2(getCutTreeArrays(t, clade), 300, seed = 1234), naive).pvalue > 1e-4
+
+@pytest.mark.parametrize('nbClades', [0, 1, 2, 3])
+def test_surrogate_stats_and_plot_with_few_clades(nbClades):
+	arm = TmpObject()
+	arm.origW2 = [0.5 * i for i in range(nbClades)]
+	arm.surrW2 = [-0.25 * i for i in range(nbClades)]
+	arm.stats = getSurrogateStats(arm)
+	assert sorted(arm.stats) == sorted(surrogateStatNames)
+	assert np.isnan(arm.stats['correl']) == (nbClades < 3)
+	assert np.isnan(arm.stats['origW2Mean']) == (nbClades == 0)
+	W2SurrogateTestingPlotter(arm).Plot()
+	plt.close('all')
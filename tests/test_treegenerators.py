@@ -0,0 +1,62 @@
+import math
+import random
+import numpy as np
+import pytest
+from scipy.stats import ks_2samp
+from TreeGenerators import *
+from Simulations import *
+
+def getHeights(treeGenerator, endCondition, nbTrees):
+	return [getTreeIndex(treeGenSimFunc((endCondition, treeGenerator))[0]).GetHeight() for i in range(nbTrees)]
+
+def getNbExtant(t):
+	return len([n for n in t.leaf_node_iter() if not getattr(n, 'is_extinct', False)])
+
+# Both generators simulate the same pure birth process, their tree heights must have the same distribution
+def test_neutral_matches_rate_function_generator():
+	random.seed(1234)
+	np.random.seed(1234)
+	endCondition = NumExtantStopCrit(Parameters(num_extant_tips = 30))
+	neutral = NeutralTreeGenerator(Parameters(birth_rate = 1.0, death_rate = 0.0))
+	rateFunc = RateFunctionTreeGenerator(Parameters(birth_rf = ConstantRateFunction(Parameters(rate = 1.0)),
+		death_rf = ConstantRateFunction(Parameters(rate = 0.0))))
+	neutralHeights = getHeights(neutral, endCondition, 300)
+	assert ks_2samp(neutralHeights, getHeights(rateFunc, endCondition, 300)).pvalue > 1e-4
+	# Time to go from k to k+1 lineages is exponential of rate k
+	expMean = sum(1.0 / k for k in range(1, 30))
+	expStd = math.sqrt(sum(1.0 / k**2 for k in range(1, 30)))
+	assert abs(np.mean(neutralHeights) - expMean) < 5 * expStd / math.sqrt(len(neutralHeights))
+
+@pytest.mark.parametrize('deathRate', [0.0, 0.4])
+def test_neutral_generator_num_extant(deathRate):
+	endCondition = NumExtantStopCrit(Parameters(num_extant_tips = 25))
+	treeGenerator = NeutralTreeGenerator(Parameters(birth_rate = 1.0, death_rate = deathRate))
+	for i in range(20):
+		t, rej = treeGenSimFunc((endCondition, treeGenerator))
+		assert getNbExtant(t) == 25
+		index = getTreeIndex(t)
+		times = index.GetTimes()
+		# Extant tips are all at the present
+		for j in np.flatnonzero(index.isLeaf):
+			if not getattr(index.nodes[j], 'is_extinct', False):
+				assert times[j] == pytest.approx(index.GetHeight())
+
+def test_neutral_generator_max_time():
+	maxTime = 3.0
+	endCondition = MaxTimeStopCrit(Parameters(max_time = maxTime))
+	treeGenerator = NeutralTreeGenerator(Parameters(birth_rate = 1.0, death_rate = 0.4))
+	for i in range(200):
+		t, rej = treeGenSimFunc((endCondition, treeGenerator))
+		index = getTreeIndex(t)
+		times = index.GetTimes()
+		assert index.GetHeight() >= maxTime
+		# Extant tips are cut at maxTime
+		for j in np.flatnonzero(index.isLeaf):
+			if not getattr(index.nodes[j], 'is_extinct', False):
+				assert times[j] == pytest.approx(maxTime)
+
+@pytest.mark.parametrize('birthRate, deathRate', [(0.0, 0.0), (-1.0, 1.0), (1.0, -0.5)])
+def test_neutral_generator_invalid_rates(birthRate, deathRate):
+	treeGenerator = NeutralTreeGenerator(Parameters(birth_rate = birthRate, death_rate = deathRate))
+	with pytest.raises(ValueError):
+		treeGenerator.generate(NumExtantStopCrit())
@@ -0,0 +1,97 @@
+import random
+import numpy as np
+import pytest
+from dendropy.simulate import treesim
+from TreeIndex import *
+from ResultAnalyzers import *
+
+# Random trees with a root edge, ultrametric without extinctions and with extinct tips otherwise
+def getRandomTrees(deathRate, nbTrees = 5, nbTips = 40):
+	rng = random.Random(1234)
+	trees = []
+	for i in range(nbTrees):
+		t = treesim.birth_death_tree(birth_rate = 1.0, death_rate = deathRate, num_extant_tips = nbTips, is_retain_extinct_tips = True, rng = rng)
+		t.seed_node.edge.length = rng.random()
+		trees.append(t)
+	return trees
+
+# Node times computed by ResultAnalyzers before TreeIndex
+def getTreeAgesNaive(t):
+	rootTime = t.seed_node.edge.length if t.seed_node.edge.length is not None else 0
+	rootDists = {}
+	for n in t.preorder_node_iter():
+		rootDists[n] = n.edge.length + rootDists[n.parent_node] if n.parent_node is not None else 0
+	return {n:rootTime + d for n, d in rootDists.items()}
+
+# Birth and death events computed by ResultAnalyzers before TreeIndex
+def getRawRateDataNaive(node, ages):
+	epsilon = 0.00001
+	stTotTime = max(ages[nd] for nd in node.leaf_iter())
+	rawRate = {}
+	for name in RateNames:
+		rawRate[name] = TmpObject()
+		rawRate[name].time = []
+		rawRate[name].rate = []
+		rawRate[name].nbLin = []
+	tmpNbLin = 1
+	for n in sorted(node.preorder_iter(), key = lambda n: ages[n]):
+		if stTotTime - ages[n] > epsilon:
+			sigs = rawRate['death'] if n.is_leaf() else rawRate['birth']
+			sigs.time.append(ages[n])
+			sigs.rate.append(1)
+			sigs.nbLin.append(tmpNbLin)
+			tmpNbLin += -1 if n.is_leaf() else 1
+	return rawRate
+
+@pytest.mark.parametrize('deathRate', [0.0, 0.4])
+def test_index_matches_dendropy(deathRate):
+	for t in getRandomTrees(deathRate):
+		index = getTreeIndex(t)
+		assert getTreeIndex(t) is index
+		nodes = list(t.preorder_node_iter())
+		assert index.nodes == nodes
+		assert index.parents.tolist() == [-1] + [nodes.index(nd.parent_node) for nd in nodes[1:]]
+		t.calc_node_root_distances(return_leaf_distances_only = False)
+		assert index.rootDists.tolist() == [nd.root_distance for nd in nodes]
+		assert index.depths.tolist() == [nd.level() for nd in nodes]
+		assert index.leafCounts.tolist() == [len(nd.leaf_nodes()) for nd in nodes]
+		t.calc_node_ages(ultrametricity_precision = False)
+		assert index.ages.tolist() == [nd.age for nd in nodes]
+		assert [nodes[i] for i in index.ageOrder] == list(t.ageorder_node_iter(include_leaves = True, descending = True))
+		for i, c in enumerate(nodes):
+			assert [nodes[j] for j in index.GetClade(i)] == list(c.preorder_iter())
+			assert [nodes[j] for j in index.GetCladeByAge(i)] == list(c.ageorder_iter(include_leaves = True, descending = True))
+			for j, nd in enumerate(nodes):
+				assert index.IsInClade(j, i) == (nd is c or c in nd.ancestor_iter())
+
+@pytest.mark.parametrize('deathRate', [0.0, 0.4])
+def test_index_matches_naive_rate_data(deathRate):
+	for t in getRandomTrees(deathRate):
+		index = getTreeIndex(t)
+		ages = getTreeAgesNaive(t)
+		assert getTreeAges(t) == ages
+		maxTime = max(ages.values())
+		presentAges = [maxTime - ages[nd] if maxTime - ages[nd] > 0.00001 else 0.0 for nd in index.nodes]
+		assert index.GetPresentAges().tolist() == presentAges
+		for i in range(0, index.GetNbNodes(), 5):
+			if index.isLeaf[i]:
+				continue
+			naive = getRawRateDataNaive(index.nodes[i], ages)
+			rawRate = getRawRateData(index, i)
+			for name in RateNames:
+				assert list(rawRate[name].time) == naive[name].time
+				assert list(rawRate[name].nbLin) == naive[name].nbLin
+				assert list(rawRate[name].rate) == naive[name].rate
+
+def test_index_is_rebuilt_after_invalidation():
+	t = getRandomTrees(0.0, nbTrees = 1)[0]
+	index = getTreeIndex(t)
+	leaf = t.leaf_nodes()[0]
+	leaf.edge.length += 1.0
+	invalidateTreeIndex(t)
+	newIndex = getTreeIndex(t)
+	assert newIndex is not index
+	# Leaves of trees without extinctions are all at the present
+	assert newIndex.GetHeight() == pytest.approx(index.GetHeight() + 1.0)
+	with pytest.raises(ValueError):
+		newIndex.ages[0] = 0.0
@@ -0,0 +1,49 @@
+import random
+import dendropy
+import pytest
+from dendropy.simulate import treesim
+from TreeUtilities import *
+
+def getTrees():
+	rng = random.Random(1234)
+	trees = [treesim.birth_death_tree(birth_rate = 1.0, death_rate = 0.3, num_extant_tips = 30, is_retain_extinct_tips = True, rng = rng)]
+	# Caterpillar tree, the deepest case for walks up the parent chain
+	t = dendropy.Tree(taxon_namespace = dendropy.TaxonNamespace())
+	nd = t.seed_node
+	for i in range(30):
+		nd.new_child().edge.length = 1.0
+		nd = nd.new_child()
+		nd.edge.length = 1.0
+	trees.append(t)
+	return trees
+
+# Plotters of the clade, as returned by NodePlotter before plotters were numbered
+def getAllNodesNaive(plotter):
+	res = [plotter]
+	for c in plotter.children:
+		res += getAllNodesNaive(c)
+	return res
+
+# Clade membership, as tested by NodePlotter before plotters were numbered
+def isInCladeNaive(plotter, cladeInd, cladeInds):
+	tmp = plotter
+	while tmp is not None:
+		if cladeInds[tmp.node] == cladeInd:
+			return True
+		tmp = tmp.parent
+	return False
+
+@pytest.mark.parametrize('t', getTrees())
+def test_node_plotter_matches_naive(t):
+	cladeInds = {nd:i for i, nd in enumerate(t)}
+	root = NodePlotter(t.seed_node, EdgePlotter)
+	allNodes = getAllNodesNaive(root)
+	assert [p.node for p in allNodes] == list(t.preorder_node_iter())
+	for p in allNodes:
+		assert p.GetAllNodes() == getAllNodesNaive(p)
+		assert p.GetAllAttr('time') == [c.time for c in getAllNodesNaive(p)]
+		assert root.GetNodeFromInd(cladeInds[p.node]) is p
+		for i in range(len(allNodes)):
+			assert p.IsInClade(i) == isInCladeNaive(p, i, cladeInds)
+	assert root.GetNodeFromInd(len(allNodes)) is None
+	assert not root.IsInClade(len(allNodes))
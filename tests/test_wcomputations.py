@@ -0,0 +1,34 @@
+import random
+import pytest
+import numpy as np
+from dendropy.simulate import treesim
+from WComputations import *
+
+# Seeded random birth-death trees, ultrametric without death and with extinct tips otherwise
+def getRandomTrees(deathRate, nbTrees = 5, nbTips = 40):
+	rng = random.Random(1234)
+	return [treesim.birth_death_tree(birth_rate = 1.0, death_rate = deathRate, num_extant_tips = nbTips,
+		is_retain_extinct_tips = True, rng = rng) for i in range(nbTrees)]
+
+@pytest.mark.parametrize('deathRate', [0.0, 0.4])
+def test_computeW_matches_naive(deathRate):
+	for t in getRandomTrees(deathRate):
+		for nd in t.preorder_node_iter():
+			if nd.is_internal():
+				assert computeW(t, nd) == computeWNaive(t, nd)
+
+@pytest.mark.parametrize('deathRate', [0.0, 0.4])
+def test_computeAllW_matches_computeW(deathRate):
+	for t in getRandomTrees(deathRate):
+		allW = computeAllW(t)
+		for i, nd in enumerate(t.preorder_node_iter()):
+			assert allW[i] == (computeW(t, nd) if nd.is_internal() else 0.0)
+
+def test_computeW2Batch_matches_naive():
+	for t in getRandomTrees(0.0):
+		clades = [nd for nd in t.preorder_node_iter() if nd.is_internal() and nd.parent_node is not None]
+		batch = computeW2Batch(t, clades)
+		batchPis = [np.array(c.W2_pi) for c in clades]
+		for c, w2, pis in zip(clades, batch, batchPis):
+			assert computeW2Naive(t, c) == pytest.approx(w2, abs = 1e-12)
+			assert np.allclose(c.W2_pi, pis, rtol = 0, atol = 1e-15)